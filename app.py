@@ -1,35 +1,223 @@
-from flask import Flask, render_template, request, send_file, jsonify, send_from_directory
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-from urllib.parse import urlencode
-from bs4 import BeautifulSoup
+from flask import Flask, render_template, request, send_file, jsonify, send_from_directory, Response, stream_with_context
+from werkzeug.middleware.proxy_fix import ProxyFix
+from urllib.parse import urlencode, quote
 import concurrent.futures
-from time import sleep
-import threading, io, os, re, random, logging, cloudscraper
+import asyncio
+import threading, os, random, logging, time, argparse, json, uuid, collections, heapq, sqlite3, cloudscraper
+from chapter_store import ChapterStore
+from rate_limit import RateScheduler
+from async_engine import AsyncEngine
+from parsers import get_parser
+from postprocess import RubyFormatter, chapter_html_to_text
+from spool import NovelSpool
+from archive import NovelArchive
+from exporters import FORMATS, iter_aozora, iter_chapter_zip, iter_epub, iter_text_zip
+from job_backend import MemoryJobBackend, SqliteJobBackend
+from result_store import ResultStore
+from job_queue import JobQueue, get_worker_id
+from search_cache import SearchCache, get_search_key
+from scraper_pool import ScraperPool
+from metrics import MetricsRegistry, StructuredFormatter, TimedParser
+from sites import HamelnSite, NarouSite, SiteRegistry, get_validator_headers
+from search_index import SearchIndex
+from catalog import NovelCatalog, get_unsupported_filters
+from job_scheduler import PRIORITIES, JobScheduler
 
 app = Flask(__name__)
 
-logging.basicConfig(level=logging.INFO)
+CACHE_DIR = os.environ.get('CACHE_DIR', 'cache')
+CHAPTER_CACHE_MAX_BYTES = int(os.environ.get('CHAPTER_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+CHAPTER_CACHE_MAX_AGE = int(os.environ.get('CHAPTER_CACHE_MAX_AGE', 30 * 24 * 3600))
+CHAPTER_CACHE_FRESH_FOR = int(os.environ.get('CHAPTER_CACHE_FRESH_FOR', 7 * 24 * 3600))
+NOVEL_ARCHIVE = os.environ.get('NOVEL_ARCHIVE', '1') == '1'
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(CACHE_DIR, 'archive'))
+CHAPTER_WORKERS = int(os.environ.get('CHAPTER_WORKERS', 2))
+RATE_LIMIT_RPS = float(os.environ.get('RATE_LIMIT_RPS', 0.5))
+RATE_LIMIT_MIN_RPS = float(os.environ.get('RATE_LIMIT_MIN_RPS', 0.05))
+RATE_LIMIT_MAX_RPS = float(os.environ.get('RATE_LIMIT_MAX_RPS', 2.0))
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 2))
+RATE_LIMIT_PENALTY = float(os.environ.get('RATE_LIMIT_PENALTY', 30))
+FETCH_ENGINE = os.environ.get('FETCH_ENGINE', 'thread')
+HTML_PARSER = os.environ.get('HTML_PARSER', 'auto')
+RUBY_MODE = os.environ.get('RUBY_MODE', 'strip')
+RESULT_TTL = int(os.environ.get('RESULT_TTL', 6 * 3600))
+RESULT_MAX_ITEMS = int(os.environ.get('RESULT_MAX_ITEMS', 1000))
+RESULT_MAX_BYTES = int(os.environ.get('RESULT_MAX_BYTES', 1024 * 1024 * 1024))
+RESULT_SPILL_DIR = os.environ.get('RESULT_SPILL_DIR')
+JOB_QUEUE = os.environ.get('JOB_QUEUE', 'none')
+JOB_QUEUE_DB = os.environ.get('JOB_QUEUE_DB', os.path.join(CACHE_DIR, 'queue.sqlite3'))
+JOB_BACKEND = os.environ.get('JOB_BACKEND', 'sqlite' if JOB_QUEUE == 'sqlite' else 'memory')
+JOB_DB = os.environ.get('JOB_DB', os.path.join(CACHE_DIR, 'jobs.sqlite3'))
+JOB_CLAIM_TIMEOUT = int(os.environ.get('JOB_CLAIM_TIMEOUT', 600))
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 2))
+WORKER_POLL_INTERVAL = float(os.environ.get('WORKER_POLL_INTERVAL', 2))
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 15 * 60))
+SEARCH_CACHE_MAX_ITEMS = int(os.environ.get('SEARCH_CACHE_MAX_ITEMS', 500))
+SCRAPER_POOL_SIZE = int(os.environ.get('SCRAPER_POOL_SIZE', 2))
+SCRAPER_MAX_AGE = int(os.environ.get('SCRAPER_MAX_AGE', 1800))
+SCRAPER_MAX_USES = int(os.environ.get('SCRAPER_MAX_USES', 1000))
+SCRAPER_IDLE_TIMEOUT = int(os.environ.get('SCRAPER_IDLE_TIMEOUT', 300))
+SCRAPER_COOKIE_DIR = os.environ.get('SCRAPER_COOKIE_DIR', os.path.join(CACHE_DIR, 'cookies'))
+SCRAPER_WARM_URLS = [url for url in os.environ.get('SCRAPER_WARM_URLS', '').split(',') if url]
+HAMELN_BASE_URL = os.environ.get('HAMELN_BASE_URL', 'https://syosetu.org')
+NAROU_API_URL = os.environ.get('NAROU_API_URL', 'https://api.syosetu.com/novelapi/api/')
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 4))
+SSE_MAX_DURATION = int(os.environ.get('SSE_MAX_DURATION', 60))
+SSE_KEEPALIVE = int(os.environ.get('SSE_KEEPALIVE', 15))
+BATCH_MAX_NOVELS = int(os.environ.get('BATCH_MAX_NOVELS', 100))
+BATCH_JOBS = int(os.environ.get('BATCH_JOBS', 3))
+BATCH_CHAPTER_WORKERS = int(os.environ.get('BATCH_CHAPTER_WORKERS', 4))
+SEARCH_INDEX = os.environ.get('SEARCH_INDEX', '1') == '1'
+SEARCH_INDEX_DB = os.environ.get('SEARCH_INDEX_DB', os.path.join(CACHE_DIR, 'search.sqlite3'))
+SEARCH_INDEX_BACKFILL = os.environ.get('SEARCH_INDEX_BACKFILL', '0') == '1'
+LOCAL_SEARCH_MAX_RESULTS = int(os.environ.get('LOCAL_SEARCH_MAX_RESULTS', 100))
+CATALOG = os.environ.get('CATALOG', '1') == '1'
+CATALOG_DB = os.environ.get('CATALOG_DB', os.path.join(CACHE_DIR, 'catalog.sqlite3'))
+CATALOG_CRAWL_INTERVAL = int(os.environ.get('CATALOG_CRAWL_INTERVAL', 0))
+CATALOG_CRAWL_PAGES = int(os.environ.get('CATALOG_CRAWL_PAGES', 20))
+JOB_MAX_CONCURRENT = int(os.environ.get('JOB_MAX_CONCURRENT', 4))
+JOB_MAX_PER_USER = int(os.environ.get('JOB_MAX_PER_USER', 2))
+JOB_MAX_INFLIGHT = int(os.environ.get('JOB_MAX_INFLIGHT', CHAPTER_WORKERS))
+JOB_MAX_WAIT = int(os.environ.get('JOB_MAX_WAIT', 60))
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 5))
+RETRY_BACKOFF = float(os.environ.get('RETRY_BACKOFF', 2))
+RETRY_MAX_BACKOFF = float(os.environ.get('RETRY_MAX_BACKOFF', 120))
+BREAKER_THRESHOLD = int(os.environ.get('BREAKER_THRESHOLD', 5))
+BREAKER_COOLDOWN = float(os.environ.get('BREAKER_COOLDOWN', 30))
+BREAKER_MAX_COOLDOWN = float(os.environ.get('BREAKER_MAX_COOLDOWN', 600))
+PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+USER_HEADER = os.environ.get('USER_HEADER', '')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
 
-logger = logging.getLogger('LoggingTest')
-sh = logging.StreamHandler()
-logger.addHandler(sh)
-logger.setLevel(logging.INFO)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(StructuredFormatter(as_json=LOG_FORMAT == 'json'))
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_handler])
 
+logger = logging.getLogger('hameln')
 
-progress_store = {}
-novel_store = {}
-background_tasks = {}
-lock = threading.Lock()
+# Per-user job caps key on the client address. Behind reverse proxies, set
+# PROXY_FIX_X_FOR to how many there are (1 on Render) so the address is read
+# from X-Forwarded-For; entries beyond that many hops are client-supplied
+# and ignored. USER_HEADER names a header holding the user for deployments
+# whose proxy authenticates users and sets it; leave it unset wherever
+# clients can send that header themselves, since they could pick any user.
+if PROXY_FIX_X_FOR:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIX_X_FOR)
 
-def get_session():
-    session = requests.Session()
-    retry = Retry(total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
+def log(level, message, **fields):
+    logger.log(level, message, extra={'fields': fields})
+
+metrics = MetricsRegistry()
+request_seconds = metrics.histogram('hameln_request_seconds', 'Upstream request latency, excluding rate limiter waits.', ['host'])
+request_wait_seconds = metrics.histogram('hameln_request_wait_seconds', 'Time spent waiting for the per-host rate limiter.', ['host'])
+requests_total = metrics.counter('hameln_requests_total', 'Upstream requests by response status.', ['host', 'status'])
+challenges_total = metrics.counter('hameln_challenges_total', 'Responses treated as a challenge or throttling.', ['host'])
+retries_total = metrics.counter('hameln_retries_total', 'Failed chapter fetch attempts that were retried.', ['site'])
+chapters_total = metrics.counter('hameln_chapters_total', 'Chapters by where their text came from.', ['source'])
+parse_seconds = metrics.histogram('hameln_parse_seconds', 'HTML parse time per page type.', ['page'])
+postprocess_seconds = metrics.histogram('hameln_postprocess_seconds', 'Chapter HTML to text conversion time.')
+assemble_seconds = metrics.histogram('hameln_assemble_seconds', 'Time to close a novel\'s spool and archive.')
+jobs_total = metrics.counter('hameln_jobs_total', 'Finished scraping jobs by final state.', ['state'])
+job_seconds = metrics.histogram('hameln_job_seconds', 'Scraping job duration.', buckets=(10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200))
+
+def observe_request(host, waited, elapsed, status, throttled):
+    request_wait_seconds.observe(waited, host=host)
+    request_seconds.observe(elapsed, host=host)
+    requests_total.inc(host=host, status=status or 'error')
+    if throttled:
+        challenges_total.inc(host=host)
+
+
+if JOB_BACKEND == 'sqlite':
+    job_backend = SqliteJobBackend(JOB_DB, ttl=RESULT_TTL, max_bytes=RESULT_MAX_BYTES, claim_timeout=JOB_CLAIM_TIMEOUT)
+else:
+    job_backend = MemoryJobBackend(ttl=RESULT_TTL, max_items=RESULT_MAX_ITEMS, max_bytes=RESULT_MAX_BYTES, spill_dir=RESULT_SPILL_DIR)
+job_queue = JobQueue(JOB_QUEUE_DB, claim_timeout=JOB_CLAIM_TIMEOUT, max_wait=JOB_MAX_WAIT) if JOB_QUEUE == 'sqlite' else None
+job_scheduler = JobScheduler(max_jobs=JOB_MAX_CONCURRENT, max_jobs_per_user=JOB_MAX_PER_USER, max_wait=JOB_MAX_WAIT)
+chapter_store = ChapterStore(
+    os.path.join(CACHE_DIR, 'chapters.sqlite3'),
+    max_bytes=CHAPTER_CACHE_MAX_BYTES,
+    max_age=CHAPTER_CACHE_MAX_AGE,
+    fresh_for=CHAPTER_CACHE_FRESH_FOR
+)
+rate_scheduler = RateScheduler(
+    observe=observe_request,
+    rank=job_scheduler.rank,
+    max_wait=JOB_MAX_WAIT,
+    rate=RATE_LIMIT_RPS,
+    burst=RATE_LIMIT_BURST,
+    min_rate=RATE_LIMIT_MIN_RPS,
+    max_rate=RATE_LIMIT_MAX_RPS,
+    penalty=RATE_LIMIT_PENALTY,
+    breaker_threshold=BREAKER_THRESHOLD,
+    breaker_cooldown=BREAKER_COOLDOWN,
+    breaker_max_cooldown=BREAKER_MAX_COOLDOWN
+)
+async_engine = AsyncEngine()
+html_parser = TimedParser(get_parser(HTML_PARSER), parse_seconds)
+ruby_formatter = RubyFormatter(RUBY_MODE)
+search_cache = SearchCache(ttl=SEARCH_CACHE_TTL, max_items=SEARCH_CACHE_MAX_ITEMS, spill_dir=RESULT_SPILL_DIR)
+sse_streams = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+search_index = None
+if SEARCH_INDEX:
+    try:
+        search_index = SearchIndex(SEARCH_INDEX_DB)
+    except sqlite3.OperationalError as e:
+        # The trigram tokenizer needs SQLite 3.34 or later.
+        log(logging.WARNING, 'search index disabled', error=str(e), sqlite_version=sqlite3.sqlite_version)
+catalog = NovelCatalog(CATALOG_DB) if CATALOG else None
+sites = SiteRegistry([
+    HamelnSite(html_parser, base_url=HAMELN_BASE_URL),
+    NarouSite(html_parser, api_url=NAROU_API_URL, workers=CHAPTER_WORKERS)
+])
+# One budget shared by every batch: BATCH_JOBS novels at a time whose
+# chapter fetches all run on BATCH_CHAPTER_WORKERS threads. The per-host
+# limiter hands out requests round-robin by job, so the novels interleave.
+batches = ResultStore(ttl=RESULT_TTL, max_items=RESULT_MAX_ITEMS)
+batch_jobs = concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_JOBS, thread_name_prefix='batch-job')
+batch_chapters = concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_CHAPTER_WORKERS, thread_name_prefix='batch-chapter')
+for site in sites:
+    for host, policy in site.rate_policy.items():
+        rate_scheduler.set_policy(host, **policy)
+
+def get_result_store_stats():
+    stats = job_backend.stats()
+    return stats.get('novel_store', stats)
+
+metrics.gauge('hameln_active_jobs', 'Jobs currently being scraped.', collect=lambda: job_backend.stats()['running'])
+metrics.gauge('hameln_queue_depth', 'Jobs waiting in the queue for a worker.', collect=lambda: job_queue.stats()['queued'] if job_queue else 0)
+metrics.gauge(
+    'hameln_circuit_open', 'Whether requests to a host are paused by its circuit breaker.', ['host'],
+    collect=lambda: {(host, ): int(state['breaker'] != 'closed') for host, state in rate_scheduler.stats().items()}
+)
+metrics.gauge('hameln_scheduler_pending_jobs', 'Jobs waiting for a scheduler slot.', collect=lambda: job_scheduler.stats()['pending'])
+metrics.gauge('hameln_chapter_store_bytes', 'Size of the cached chapter text as stored, deduplicated and compressed.', collect=lambda: chapter_store.stats()['bytes'])
+metrics.gauge('hameln_chapter_store_logical_bytes', 'Size of the cached chapter text counted per chapter, uncompressed.', collect=lambda: chapter_store.stats()['logical_bytes'])
+metrics.gauge('hameln_chapter_store_chapters', 'Chapters in the chapter cache.', collect=lambda: chapter_store.stats()['chapters'])
+metrics.counter('hameln_chapter_store_evictions_total', 'Chapters evicted from the chapter cache.', collect=lambda: chapter_store.stats()['evictions'])
+metrics.gauge('hameln_result_store_bytes', 'Size of the finished novels kept for download.', collect=lambda: get_result_store_stats().get('bytes', 0))
+metrics.counter('hameln_result_store_evictions_total', 'Finished novels evicted before they expired.', collect=lambda: get_result_store_stats().get('evictions', 0))
+metrics.counter(
+    'hameln_search_cache_total', 'Search requests by cache outcome.', ['result'],
+    collect=lambda: {(result,): search_cache.stats()[result] for result in ('hits', 'misses', 'coalesced')}
+)
+metrics.counter(
+    'hameln_scraper_sessions_total', 'Pooled scraper sessions by lifecycle event.', ['event'],
+    collect=lambda: {(event,): scraper_pool.stats()[event] for event in ('created', 'reused', 'recycled')}
+)
+metrics.gauge('hameln_search_index_chapters', 'Chapters in the local full-text index.', collect=lambda: search_index.stats()['chapters'] if search_index else 0)
+metrics.gauge('hameln_catalog_novels', 'Novels in the local search metadata catalog.', collect=lambda: catalog.stats()['novels'] if catalog else 0)
+metrics.gauge('hameln_search_index_queue_depth', 'Chapters waiting to be indexed.', collect=lambda: search_index.queue.qsize() if search_index else 0)
+scraper_pool = ScraperPool(
+    lambda: cloudscraper.create_scraper(),
+    size=SCRAPER_POOL_SIZE,
+    max_age=SCRAPER_MAX_AGE,
+    max_uses=SCRAPER_MAX_USES,
+    idle_timeout=SCRAPER_IDLE_TIMEOUT,
+    connections=max(CHAPTER_WORKERS, 2),
+    cookie_dir=SCRAPER_COOKIE_DIR
+)
 
 def get_random_user_agent():
     user_agents = [
@@ -42,60 +230,102 @@ def get_random_user_agent():
     return random.choice(user_agents)
 
 def get_random_referer():
-    referers = [
-        "https://www.google.com/search?q=%E3%83%8F%E3%83%BC%E3%83%A1%E3%83%AB%E3%83%B3&ie=UTF-8&oe=UTF-8&hl=ja-jp&client=safari",
-        "https://syosetu.org/",
-        "https://syosetu.org/search/?mode=search",
-        "https://syosetu.org/?mode=rank",
-        "https://syosetu.org/?mode=favo"
-    ]
-    return random.choice(referers)
+    return random.choice(HamelnSite.referers)
     
-def get_narou_random_referer():
-    referers = [
-        "https://www.google.com/search?q=%E5%B0%8F%E8%AA%AC%E5%AE%B6%E3%81%AB%E3%81%AA%E3%82%8D%E3%81%86&ie=utf-8&oe=utf-8",
-        "https://www.google.com/search?q=%E5%B0%8F%E8%AA%AC%E3%82%92%E8%AA%AD%E3%82%82%E3%81%86&ie=utf-8&oe=utf-8",
-        "https://syosetu.com/user/top/",
-        "https://syosetu.com/favnovelmain/list/?nowcategory=2&order=newlist",
-        "https://yomou.syosetu.com/search.php",
-        "https://yomou.syosetu.com/rank/top/"
-    ]
-    return random.choice(referers)
+def get_session_headers(scraper, site=None):
+    # Cloudflare binds clearance cookies to the User-Agent that solved the
+    # challenge, so pooled sessions keep their own instead of a random one.
+    headers = {**get_headers(), "User-Agent": scraper.headers.get("User-Agent") or get_random_user_agent()}
+    if site is not None:
+        headers["Referer"] = site.get_referer()
+    return headers
 
-def get_random_delay():
-    return random.uniform(2, 8)
+def get_toc(scraper, site, novel_url, headers, nid):
+    cached = chapter_store.get_toc(nid)
+    previous_updated_at = cached['updated_at'] if cached else []
 
-def get_chapter_text(scraper, url, headers, nid, wasuu, retry_count=3):
-    for _ in range(retry_count):
+    def fetch(url, headers=None, session_headers=headers):
+        response = rate_scheduler.get(scraper, url, job=nid, headers={**session_headers, **(headers or {})}, cookies=site.get_cookies(nid))
+        if response.status_code >= 400:
+            raise ValueError(f'{url}: HTTP {response.status_code}')
+        return response
+
+    for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
         try:
-            sleep(get_random_delay())
-            response = scraper.get(url, headers=headers,cookies={'ETURAN': f'{nid}_{wasuu}', 'over18':'off'})
-            soup = BeautifulSoup(response.text, "html.parser")
-            chapter_title_tags = soup.find(id='maind')
-            if chapter_title_tags.find('span', class_='alert_color'):
-                chapter_title_tag = chapter_title_tags.find_all('span')[2]
-            else:
-                chapter_title_tag = chapter_title_tags.find_all('span')[1]
-            chapter_title_text = chapter_title_tag.decode_contents()
-            for tag in ['ruby', 'rb', 'rt', 'rp']:
-                chapter_title_text = chapter_title_text.replace(f'<{tag}>', '').replace(f'</{tag}>', '')
-            result = [str(part).strip() for part in chapter_title_text.split('<br/>') if part.strip()]
-            chapter_title = (
-                f'# {result[0]}\n## {result[1]}\n\n' if len(result) == 2 else 
-                f'## {result[0]}\n\n' if len(result) == 1 else 
-                ''
-            )
-            chapter_text = '\n'.join(p.text for p in soup.find(id='honbun').find_all('p'))
-            return chapter_title + chapter_text
+            toc = site.get_toc(fetch, novel_url, nid, cached, lambda: chapter_store.get_updated_at(nid))
+            break
         except Exception as e:
-            print(f"Error fetching {url}: {str(e)}. Retrying...")
-            sleep(get_random_delay())
-    return ""
+            # One request per job, so waiting here costs little; the circuit
+            # breaker keeps an outage from using the attempts up.
+            if attempt == RETRY_MAX_ATTEMPTS:
+                raise
+            log(logging.WARNING, 'toc fetch failed', nid=nid, url=novel_url, attempt=attempt, error=str(e))
+            time.sleep(get_retry_delay(attempt))
+    if toc is None:
+        return cached['title'], [(site.get_chapter_url(novel_url, i), None) for i in range(len(previous_updated_at))], previous_updated_at, previous_updated_at
+    chapter_store.put_toc(nid, toc.title, toc.updated_at, toc.etag, toc.last_modified)
+    return toc.title, toc.chapters, toc.updated_at, previous_updated_at
 
+def handle_chapter_response(response, site, nid, wasuu, group, cached, updated_at):
+    if response.status_code == 304 and cached:
+        chapter_store.touch(nid, wasuu, updated_at)
+        chapters_total.inc(source='not_modified')
+        return cached['text']
+    if response.status_code >= 400:
+        raise ValueError(f'HTTP {response.status_code}')
+    content_hash = site.get_content_hash(response.text)
+    if cached and content_hash and cached['content_hash'] == content_hash:
+        chapter_store.touch(nid, wasuu, updated_at)
+        chapters_total.inc(source='unchanged')
+        return cached['text']
+    result, paragraphs = site.parse_chapter(response.text, group)
+    chapter_title = (
+        f'# {result[0]}\n## {result[1]}\n\n' if len(result) == 2 else 
+        f'## {result[0]}\n\n' if len(result) == 1 else 
+        ''
+    )
+    with postprocess_seconds.time():
+        chapter_text = chapter_html_to_text(paragraphs)
+    chapters_total.inc(source='fetched')
+    chapter_store.put(
+        nid, wasuu, chapter_title + chapter_text, updated_at,
+        response.headers.get('ETag'), response.headers.get('Last-Modified'), content_hash
+    )
+    if search_index:
+        search_index.add_chapter(nid, wasuu, chapter_title + chapter_text)
+    return chapter_title + chapter_text
 
-def get_novel_txt(novel_url: str, nid: str):
-    novel_url = novel_url.rstrip('/') + '/'
-    headers = {
+# One attempt each; failures raise and are retried by the caller after a
+# backoff (see chapter_failed), without holding a worker in the meantime.
+def get_chapter_text(scraper, site, chapter, headers, nid, wasuu, updated_at=None):
+    url, group = chapter
+    cached = chapter_store.get(nid, wasuu)
+    response = rate_scheduler.get(scraper, url, job=nid, headers={**headers, **get_validator_headers(cached)}, cookies=site.get_cookies(nid, wasuu))
+    return handle_chapter_response(response, site, nid, wasuu, group, cached, updated_at)
+
+async def get_chapter_text_async(session, site, chapter, headers, nid, wasuu, updated_at=None):
+    url, group = chapter
+    loop = asyncio.get_running_loop()
+    cached = await loop.run_in_executor(None, chapter_store.get, nid, wasuu)
+    response = await rate_scheduler.get_async(session, url, job=nid, headers={**headers, **get_validator_headers(cached)}, cookies=site.get_cookies(nid, wasuu))
+    return await loop.run_in_executor(None, handle_chapter_response, response, site, nid, wasuu, group, cached, updated_at)
+
+def get_retry_delay(attempt):
+    return min(RETRY_MAX_BACKOFF, RETRY_BACKOFF * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+def chapter_failed(site, nid, wasuu, attempt, error):
+    # Returns the delay before the next attempt, or None once the chapter
+    # has used up RETRY_MAX_ATTEMPTS and is given up as missing.
+    log(logging.WARNING, 'chapter fetch failed', nid=nid, wasuu=wasuu, attempt=attempt, error=str(error))
+    if attempt < RETRY_MAX_ATTEMPTS:
+        retries_total.inc(site=site.name)
+        return get_retry_delay(attempt)
+    chapters_total.inc(source='failed')
+    job_backend.add_error(nid, f'{wasuu}話の取得に失敗しました')
+    return None
+
+def get_headers():
+    return {
         "User-Agent": get_random_user_agent(),
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
         "Accept-Language": "ja-JP,ja;q=0.9",
@@ -104,164 +334,390 @@ def get_novel_txt(novel_url: str, nid: str):
         "Upgrade-Insecure-Requests": "1",
         "Connection": "keep-alive"
     }
-    
-    scraper = cloudscraper.create_scraper()
 
-    try:
-        sleep(get_random_delay())
-        response = scraper.get(novel_url, headers=headers, cookies={'over18':'off'})
-        soup = BeautifulSoup(response.text, "html.parser")
-        title = soup.find('div', class_='ss').find('span', attrs={'itemprop':'name'}).text
-        chapter_count = len(soup.select('a[href^="./"]'))
-
-        txt_data = [None] * chapter_count
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-            future_to_url = {executor.submit(get_chapter_text, scraper, f'{novel_url}{i+1}.html', headers, nid, i+1): i for i in range(chapter_count)}
-            completed_chapters = 0
-            for future in concurrent.futures.as_completed(future_to_url):
-                chapter_num = future_to_url[future]
+def prepare_novel(scraper, site, novel_url, headers, nid):
+    title, chapters, updated_at, previous_updated_at = get_toc(scraper, site, novel_url, headers, nid)
+    spool, missing = open_spool(nid, title, updated_at, previous_updated_at)
+    return title, chapters, updated_at, spool, missing
+
+def open_spool(nid, title, updated_at, previous_updated_at):
+    chapter_count = len(updated_at)
+    changed = [
+        i + 1 for i, chapter_updated_at in enumerate(updated_at)
+        if i >= len(previous_updated_at) or previous_updated_at[i] != chapter_updated_at
+    ]
+    job_backend.set_changed(nid, changed)
+    stored = chapter_store.get_updated_at(nid)
+    def is_fresh(i):
+        # Only chapters with no update time to compare need the full row,
+        # for its fetch time.
+        if i + 1 not in stored:
+            return False
+        if updated_at[i] is not None and stored[i + 1] is not None:
+            return stored[i + 1] == updated_at[i]
+        return chapter_store.is_fresh(chapter_store.get(nid, i + 1), updated_at[i])
+    missing = [i for i in range(chapter_count) if not is_fresh(i)]
+    chapters_total.inc(chapter_count - len(missing), source='cached')
+    log(logging.INFO, 'toc compared', nid=nid, chapters=chapter_count, changed=len(changed), missing=len(missing))
+    spool = NovelSpool(
+        get_novel_path(nid), chapter_count, set(range(chapter_count)) - set(missing),
+        lambda i: (chapter_store.get(nid, i+1) or {}).get('text', ''),
+        transform=ruby_formatter,
+        archive=get_novel_archive(nid) if NOVEL_ARCHIVE else None
+    )
+    job_backend.set_progress(nid, int(((chapter_count - len(missing)) / chapter_count) * 100) if chapter_count else 0, title)
+    job_scheduler.set_remaining(nid, len(missing))
+    return spool, missing
+
+def fetch_chapters(site, nid, title, spool, missing, fetch_chapter, executor=None):
+    # Without an executor the job gets its own CHAPTER_WORKERS threads;
+    # batches pass their shared one. Either way at most JOB_MAX_INFLIGHT
+    # chapters are submitted at once, so a long novel cannot fill a shared
+    # executor's queue ahead of the novels next to it. Failed chapters wait
+    # out their backoff here rather than on a worker, and those that run out
+    # of attempts are returned.
+    if executor is None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=CHAPTER_WORKERS) as executor:
+            return fetch_chapters(site, nid, title, spool, missing, fetch_chapter, executor)
+    chapter_count = spool.chapter_count
+    completed_chapters = chapter_count - len(missing)
+    started = time.monotonic()
+
+    pending = iter(missing)
+    retries = []
+    attempts = collections.Counter()
+    failed = []
+    future_to_url = {}
+    while True:
+        while len(future_to_url) < max(1, JOB_MAX_INFLIGHT):
+            if retries and retries[0][0] <= time.monotonic():
+                chapter_num = heapq.heappop(retries)[1]
+            else:
+                chapter_num = next(pending, None)
+                if chapter_num is None:
+                    break
+            attempts[chapter_num] += 1
+            future_to_url[executor.submit(fetch_chapter, chapter_num)] = chapter_num
+        if not future_to_url and not retries:
+            break
+        # A due retry can only be submitted once a slot frees up; until then
+        # wait for an in-flight chapter instead of spinning on a past deadline.
+        full = len(future_to_url) >= max(1, JOB_MAX_INFLIGHT)
+        timeout = max(0.0, retries[0][0] - time.monotonic()) if retries and not full else None
+        if not future_to_url:
+            time.sleep(timeout)
+            continue
+        done, _ = concurrent.futures.wait(future_to_url, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            chapter_num = future_to_url.pop(future)
+            try:
+                chapter_text = future.result()
+            except Exception as exc:
+                delay = chapter_failed(site, nid, chapter_num + 1, attempts[chapter_num], exc)
+                if delay is not None:
+                    heapq.heappush(retries, (time.monotonic() + delay, chapter_num))
+                    continue
+                failed.append(chapter_num)
+            else:
                 try:
-                    chapter_text = future.result()
-                    txt_data[chapter_num] = chapter_text
-                    completed_chapters += 1
-                    progress_store[nid] = [int((completed_chapters / chapter_count) * 100), title]
+                    spool.add(chapter_num, chapter_text)
                 except Exception as exc:
-                    print(f'Chapter {chapter_num} generated an exception: {exc}')
+                    log(logging.ERROR, 'chapter failed', nid=nid, wasuu=chapter_num + 1, error=str(exc))
+                    failed.append(chapter_num)
+            completed_chapters += 1
+            update_progress(nid, title, completed_chapters, chapter_count, completed_chapters - chapter_count + len(missing), started)
+    return sorted(failed)
 
-        novel_text = '\n\n'.join(filter(None, txt_data))
-        novel_store[nid] = [novel_text, title]
-        progress_store[nid] = [100, title]
+def update_progress(nid, title, completed, total, fetched, started):
+    # The ETA extrapolates from chapters actually fetched in this run; cached
+    # ones cost nothing and would make it far too optimistic.
+    eta = int((time.monotonic() - started) / fetched * (total - completed)) if fetched else None
+    progress = int((completed / total) * 100)
+    job_backend.set_progress(nid, progress, title, completed=completed, total=total, eta=eta)
+    job_scheduler.set_remaining(nid, total - completed)
+    if progress // 10 != int(((completed - 1) / total) * 100) // 10:
+        log(logging.INFO, 'progress', nid=nid, completed=completed, total=total, eta=eta)
 
-    except Exception as e:
-        print(f"Error fetching novel: {str(e)}")
+def get_novel_path(nid):
+    return os.path.join(CACHE_DIR, 'novels', f'{nid}.txt')
+
+def get_novel_archive(nid, create=True):
+    path = os.path.join(ARCHIVE_DIR, f'{nid}.hna')
+    return NovelArchive(path) if create or os.path.exists(path) else None
+
+def stream_archive(archive):
+    try:
+        yield from archive.iter_text(ruby_formatter)
+    finally:
+        archive.close()
+
+def get_novel_url(nid):
+    site = sites.find(nid)
+    return site.get_novel_url(nid) if site else None
 
-def get_narou_chapter_text(scraper, url, headers, nid, wasuu, retry_count=3):
-    for _ in range(retry_count):
+def get_novel_chapters(nid):
+    # Chapters for the export formats, one at a time, from the archive or,
+    # when archiving is off, from the chapter store.
+    archive = get_novel_archive(nid, create=False) if NOVEL_ARCHIVE else None
+    if archive is not None and archive.meta.get('finished_at'):
+        def read_archive():
+            try:
+                for _, text in archive.iter_chapters():
+                    yield text
+            finally:
+                archive.close()
+        return archive.meta['title'], read_archive()
+    toc = chapter_store.get_toc(nid)
+    if toc is None or job_backend.get_result(nid) is None:
+        return None
+    return toc['title'], ((chapter_store.get(nid, i+1) or {}).get('text', '') for i in range(len(toc['updated_at'])))
+
+def get_novel_text(nid):
+    # The finished .txt as (title, byte chunks), from the spooled file or,
+    # once that is evicted, rebuilt from the archive.
+    novel = job_backend.get_result(nid)
+    if novel and os.path.exists(novel[0]):
+        def read_file(path):
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(64 * 1024), b''):
+                    yield block
+        return novel[1], read_file(novel[0])
+    archive = get_novel_archive(nid, create=False) if NOVEL_ARCHIVE and not job_backend.is_running(nid) else None
+    if archive is not None and archive.meta.get('finished_at'):
+        return archive.meta['title'], (text.encode('utf-8') for text in stream_archive(archive))
+    if archive is not None:
+        archive.close()
+    return None
+
+def finish_novel(nid, title, spool, failed=()):
+    # Chapters that could not be fetched are left out of the text and listed
+    # as missing; /refetch-missing/<nid> runs the novel again for just those.
+    job_backend.set_progress(nid, 100, title, missing=[i + 1 for i in failed])
+    with assemble_seconds.time():
+        path = spool.close()
+        if spool.archive is not None:
+            spool.archive.set_meta(nid=nid, title=title, chapter_count=spool.chapter_count, finished_at=time.time())
+            stats = spool.archive.stats()
+            if stats['garbage'] > stats['bytes'] // 2:
+                spool.archive.compact()
+    job_backend.set_result(nid, path, title)
+    index_novel(nid, title, spool.chapter_count)
+
+def index_novel(nid, title, chapter_count):
+    # Fetched chapters are indexed as they arrive; this records the title and
+    # picks up cached chapters that were never indexed.
+    if search_index:
+        search_index.add_novel(nid, title, chapter_count, lambda: (get_novel_chapters(nid) or (None, ()))[1])
+
+def backfill_search_index():
+    for name in sorted(os.listdir(ARCHIVE_DIR)) if os.path.isdir(ARCHIVE_DIR) else []:
+        nid, ext = os.path.splitext(name)
+        if ext != '.hna':
+            continue
+        archive = get_novel_archive(nid, create=False)
         try:
-            sleep(get_random_delay())
-            response = scraper.get(url, headers=headers,cookies={'ETURAN': f'{nid}_{wasuu}', 'over18':'off'})
-            soup = BeautifulSoup(response.text, "html.parser")
-            chapter_title_tags = soup.find(id='maind')
-            if chapter_title_tags.find('span', class_='alert_color'):
-                chapter_title_tag = chapter_title_tags.find_all('span')[2]
-            else:
-                chapter_title_tag = chapter_title_tags.find_all('span')[1]
-            chapter_title_text = chapter_title_tag.decode_contents()
-            for tag in ['ruby', 'rb', 'rt', 'rp']:
-                chapter_title_text = chapter_title_text.replace(f'<{tag}>', '').replace(f'</{tag}>', '')
-            result = [str(part).strip() for part in chapter_title_text.split('<br/>') if part.strip()]
-            chapter_title = (
-                f'# {result[0]}\n## {result[1]}\n\n' if len(result) == 2 else 
-                f'## {result[0]}\n\n' if len(result) == 1 else 
-                ''
+            if archive is not None and archive.meta.get('finished_at'):
+                index_novel(nid, archive.meta['title'], archive.meta['chapter_count'])
+        finally:
+            if archive is not None:
+                archive.close()
+
+def get_novel_txt(novel_url: str, nid: str, site, executor=None):
+    novel_url = novel_url.rstrip('/') + '/'
+    with scraper_pool.lease(novel_url) as scraper:
+        headers = get_session_headers(scraper, site)
+        spool = None
+
+        try:
+            title, chapters, updated_at, spool, missing = prepare_novel(scraper, site, novel_url, headers, nid)
+            failed = fetch_chapters(
+                site, nid, title, spool, missing,
+                lambda i: get_chapter_text(scraper, site, chapters[i], headers, nid, i+1, updated_at=updated_at[i]),
+                executor
             )
-            chapter_text = '\n'.join(p.text for p in soup.find(id='honbun').find_all('p'))
-            return chapter_title + chapter_text
+            finish_novel(nid, title, spool, failed)
+
         except Exception as e:
-            print(f"Error fetching {url}: {str(e)}. Retrying...")
-            sleep(get_random_delay())
-    return ""
+            if spool:
+                spool.abort()
+            job_backend.add_error(nid, str(e))
+            log(logging.ERROR, 'novel failed', nid=nid, url=novel_url, error=str(e))
 
-def get_narou_novel_txt(novel_url: str, nid: str):
+async def get_novel_txt_async(novel_url: str, nid: str, site):
+    # Only the chapter requests run on the event loop; the SQLite, disk and
+    # parsing work around them goes to the default executor so it does not
+    # hold up the other requests in flight.
     novel_url = novel_url.rstrip('/') + '/'
-    headers = {
-        "User-Agent": get_random_user_agent(),
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
-        "Accept-Language": "ja-JP,ja;q=0.9",
-        "Referer": get_narou_random_referer(),
-        "DNT": "1",
-        "Upgrade-Insecure-Requests": "1",
-        "Connection": "keep-alive"
-    }
-    
-    scraper = cloudscraper.create_scraper(browser={'browser': 'chrome', 'platform': 'windows', 'mobile': False})
-    
+    loop = asyncio.get_running_loop()
+    lease = scraper_pool.lease(novel_url)
+    scraper = await loop.run_in_executor(None, lease.__enter__)
     try:
-        """
-        sleep(get_random_delay())
-        if 'ncode' in novel_url:
-            ncode = re.search(r"https://ncode\.syosetu\.com/([^/]+)/", novel_url).group(1)
-            novel_info_url = f'https://ncode.syosetu.com/novelview/infotop/ncode/{ncode}/'
-            response = scraper.get(novel_info_url, headers=headers, cookies={'over18':'yes'})
-        elif 'novel18' in novel_url:
-            ncode = re.search(r"https://novel18\.syosetu\.com/([^/]+)/", novel_url).group(1)
-            response = scraper.get(f'https://novel18.syosetu.com/novelview/infotop/ncode/{ncode}/', headers=headers, cookies={'over18':'yes'})
-        """
-        sleep(get_random_delay())
-        response = get_session().get(novel_url, headers=headers, cookies={'over18':'yes'})
-        print('Response text:', response.text[:500])
-        soup = BeautifulSoup(response.text, "html.parser")
-        print('soup: ', soup.prettify())
-        """
-        chapter_count = len(soup.select('a[href^="./"]'))
-
-        txt_data = [None] * chapter_count
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-            future_to_url = {executor.submit(get_narou_chapter_text, scraper, f'{novel_url}{i+1}.html', headers, nid, i+1): i for i in range(chapter_count)}
-            completed_chapters = 0
-            for future in concurrent.futures.as_completed(future_to_url):
-                chapter_num = future_to_url[future]
-                try:
-                    chapter_text = future.result()
-                    txt_data[chapter_num] = chapter_text
+        headers = get_session_headers(scraper, site)
+        spool = None
+
+        try:
+            # The TOC goes through cloudscraper so any challenge is solved before
+            # its cookies are handed to the aiohttp session.
+            title, chapters, updated_at, spool, missing = await loop.run_in_executor(None, prepare_novel, scraper, site, novel_url, headers, nid)
+            chapter_count = spool.chapter_count
+            completed_chapters = chapter_count - len(missing)
+            semaphore = asyncio.Semaphore(max(1, min(CHAPTER_WORKERS, JOB_MAX_INFLIGHT)))
+            started = time.monotonic()
+
+            failed = []
+
+            async with async_engine.session(scraper) as session:
+                async def fetch_chapter(i):
+                    # The backoff sleep happens outside the semaphore.
+                    for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+                        try:
+                            async with semaphore:
+                                return i, await get_chapter_text_async(session, site, chapters[i], headers, nid, i+1, updated_at=updated_at[i])
+                        except Exception as e:
+                            delay = await loop.run_in_executor(None, chapter_failed, site, nid, i + 1, attempt, e)
+                            if delay is None:
+                                return i, None
+                            await asyncio.sleep(delay)
+
+                for future in asyncio.as_completed([fetch_chapter(i) for i in missing]):
+                    chapter_num, chapter_text = await future
+                    if chapter_text is None:
+                        failed.append(chapter_num)
+                    else:
+                        await loop.run_in_executor(None, spool.add, chapter_num, chapter_text)
                     completed_chapters += 1
-                    progress_store[nid] = [int((completed_chapters / chapter_count) * 100) - 1, title]
-                except Exception as exc:
-                    print(f'Chapter {chapter_num} generated an exception: {exc}')
+                    await loop.run_in_executor(
+                        None, update_progress, nid, title, completed_chapters, chapter_count,
+                        completed_chapters - chapter_count + len(missing), started
+                    )
+
+            await loop.run_in_executor(None, finish_novel, nid, title, spool, sorted(failed))
 
-        novel_text = '\n\n'.join(filter(None, txt_data))
-        novel_store[nid] = [novel_text, title]
-        progress_store[nid] = [100, title]
-        """
+        except Exception as e:
+            if spool:
+                await loop.run_in_executor(None, spool.abort)
+            await loop.run_in_executor(None, job_backend.add_error, nid, str(e))
+            log(logging.ERROR, 'novel failed', nid=nid, url=novel_url, error=str(e))
+    finally:
+        await loop.run_in_executor(None, lease.__exit__, None, None, None)
+
+def record_job(nid):
+    status = job_backend.get_status(nid) or {}
+    seconds = time.time() - status['started_at'] if status.get('started_at') else None
+    jobs_total.inc(state=status.get('state', 'unknown'))
+    if seconds is not None:
+        job_seconds.observe(seconds)
+    log(
+        logging.INFO, 'job finished', nid=nid, title=status.get('title'), state=status.get('state'),
+        seconds=round(seconds, 1) if seconds is not None else None, errors=len(status.get('errors', []))
+    )
+
+def start_scraping_task(url, nid, site_name, executor=None):
+    try:
+        get_novel_txt(url, nid, sites.get(site_name), executor)
+    finally:
+        end_scraping_task(nid)
+
+async def start_scraping_task_async(url, nid, site_name):
+    try:
+        await get_novel_txt_async(url, nid, sites.get(site_name))
+    finally:
+        await asyncio.get_running_loop().run_in_executor(None, end_scraping_task, nid)
+
+def end_scraping_task(nid):
+    job_backend.release(nid)
+    job_scheduler.forget(nid)
+    record_job(nid)
+
+def get_job_size(nid):
+    # Chapters left to fetch as far as the last TOC knows; unknown for novels
+    # never seen, which the scheduler treats as average.
+    toc = chapter_store.get_toc(nid)
+    if toc is None:
+        return None
+    stored = chapter_store.get_updated_at(nid)
+    return sum(1 for i, updated_at in enumerate(toc['updated_at']) if stored.get(i + 1) != updated_at)
+
+def schedule_scraping_task(url, nid, site_name, engine=FETCH_ENGINE, priority=0, user=None):
+    # The claim is released by the scheduler once the job's slot is free,
+    # so a resubmit of the nid cannot overlap the finished job's slot.
+    def run():
+        job_backend.set_progress(nid, 0, '', queued=False)
+        if engine == 'async' and async_engine.available:
+            return async_engine.submit(get_novel_txt_async(url, nid, sites.get(site_name)))
+        get_novel_txt(url, nid, sites.get(site_name))
+
+    job_backend.set_progress(nid, 0, '', queued=True)
+    return job_scheduler.submit(
+        nid, run, priority=priority, size=get_job_size(nid), user=user, on_finish=lambda: end_scraping_task(nid)
+    )
+
+def run_queued_job(job):
+    if not job_backend.claim(job['nid']):
+        job_queue.retry_later(job['id'])
+        return
+    try:
+        if FETCH_ENGINE == 'async' and async_engine.available:
+            async_engine.submit(start_scraping_task_async(job['url'], job['nid'], job['site'])).result()
+        else:
+            start_scraping_task(job['url'], job['nid'], job['site'])
     except Exception as e:
-        print(f"Error fetching novel: {str(e)}")
-
-def start_scraping_task(url, nid, site):
-    current_thread = threading.current_thread()
-    with lock:
-        if nid in background_tasks and background_tasks[nid] is not current_thread and background_tasks[nid].is_alive():
-            return
-    if site == 'syosetu_org':
-        get_novel_txt(url, nid)
-    elif site == 'ncode_syosetu_com':
-        get_narou_novel_txt(url, nid)
-    with lock:
-        background_tasks.pop(nid, None)
-
-def parse_novel(novel):
-    title = novel.find('a').text
-    link = novel.find('a').get('href')
-    author_info = novel.find_all('div', class_='blo_title_sak')[-1].text.split('\n')
-    author = author_info[2][2:]
-    parody = author_info[1].replace('原作：','').replace('オリジナル：','')
-    description = novel.find('div', class_='blo_inword').text
-    status = novel.find('div', class_='blo_wasuu_base').find('span').text
-    latest = novel.find('a', attrs={'title':'最新話へのリンク'}).text
-    updated_day = novel.find('div', attrs={'title':'最終更新日'}).text
-    words = novel.find('div', attrs={'title': '総文字数'}).text.split(' ')[1]
-    evaluation = novel.find('div', class_='blo_hyouka').text.strip()[5:]
-    all_keywords = novel.find('div', class_='all_keyword').find_all('a')
-    alert_keywords = [x.text for x in novel.find('div', class_='all_keyword').find('span').find_all('a')]
-    keywords = [x.text for x in all_keywords if x.text not in alert_keywords]
-    favs = novel.find_all('div', attrs={'style': 'background-color: transparent;'})[-1].text.split('｜')[1][6:]
+        job_queue.fail(job['id'], str(e))
+        return
+    progress = job_backend.get_progress(job['nid'])
+    if progress and progress[0] >= 100:
+        job_queue.complete(job['id'])
+    else:
+        job_queue.fail(job['id'], 'scraping did not complete')
 
-    return {
-        'title': title,
-        'link': link,
-        'author': author,
-        'parody': parody,
-        'description': description,
-        'status': status,
-        'latest': latest,
-        'updated_day': f'{updated_day[:10]} {updated_day[10:]}',
-        'words': words,
-        'evaluation': evaluation,
-        'alert_keywords': alert_keywords,
-        'keywords': keywords,
-        'favs': favs
-    }
+def run_worker(concurrency):
+    worker_id = get_worker_id()
+    running = set()
+    running_lock = threading.Lock()
+
+    def work():
+        while True:
+            job = job_queue.claim_next(worker_id)
+            if job is None:
+                time.sleep(WORKER_POLL_INTERVAL)
+                continue
+            with running_lock:
+                running.add(job['id'])
+            try:
+                run_queued_job(job)
+            finally:
+                with running_lock:
+                    running.discard(job['id'])
+
+    log(logging.INFO, 'worker started', worker_id=worker_id, concurrency=concurrency)
+    for _ in range(concurrency):
+        threading.Thread(target=work, daemon=True).start()
+    while True:
+        time.sleep(JOB_CLAIM_TIMEOUT / 4)
+        with running_lock:
+            job_ids = list(running)
+        job_queue.heartbeat(job_ids)
+
+def warm_scrapers():
+    for url in SCRAPER_WARM_URLS:
+        try:
+            scraper_pool.warm(url, lambda scraper, url: rate_scheduler.get(scraper, url, job='warm', headers=get_session_headers(scraper)))
+        except Exception as e:
+            log(logging.WARNING, 'warm-up failed', url=url, error=str(e))
+
+def heartbeat_claims():
+    # Jobs can go a long time without a progress update (waiting for a
+    # scheduler slot, or for a circuit breaker to close); keep their claims
+    # alive while this process is, so no other process takes them over.
+    while True:
+        time.sleep(JOB_CLAIM_TIMEOUT / 4)
+        job_backend.heartbeat()
+
+threading.Thread(target=heartbeat_claims, daemon=True).start()
+if SCRAPER_WARM_URLS:
+    threading.Thread(target=warm_scrapers, daemon=True).start()
+if search_index and SEARCH_INDEX_BACKFILL:
+    threading.Thread(target=backfill_search_index, daemon=True).start()
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -269,77 +725,165 @@ def index():
 
 @app.route('/start-scraping', methods=['POST'])
 def start_scraping():
-    url = request.json['url']
-    match_syosetu = re.search(r'https://syosetu.org/novel/(\d+)/', url)
-    match_ncode = re.search(r'https://ncode.syosetu.com/([a-z0-9]+)/', url)
-    
-    if match_syosetu:
-        nid = match_syosetu.group(1)
-        novel_url = f"https://syosetu.org/novel/{nid}/"
-        site = 'syosetu_org'
-    elif match_ncode:
-        nid = match_ncode.group(1)
-        novel_url = f"https://ncode.syosetu.com/{nid}/"
-        site = 'ncode_syosetu_com'
-    else:
+    site, nid = sites.match(request.json['url'])
+    if site is None:
         return jsonify({"error": "Invalid URL format. Please enter a valid URL."}), 400
+    return start_job(site, nid, request.json)
 
-    with lock:
-        if nid in background_tasks and background_tasks[nid].is_alive():
+def get_request_user():
+    return (USER_HEADER and request.headers.get(USER_HEADER)) or request.remote_addr
+
+def start_job(site, nid, options):
+    novel_url = site.get_novel_url(nid)
+    priority = options.get('priority', 'normal')
+    if not isinstance(priority, str) or priority not in PRIORITIES:
+        return jsonify({"error": f"priority must be one of {', '.join(PRIORITIES)}"}), 400
+
+    if job_queue is not None:
+        # Workers claim by priority and size too; per-user caps apply only
+        # to jobs run by the web process's scheduler.
+        if job_backend.is_running(nid):
             return jsonify({"status": "in_progress", "nid": nid})
+        _, created = job_queue.enqueue(nid, novel_url, site.name, priority=PRIORITIES[priority], size=get_job_size(nid))
+        if created:
+            job_backend.set_queued(nid)
+        return jsonify({"status": "queued" if created else "in_progress", "nid": nid})
+    if not job_backend.claim(nid):
+        return jsonify({"status": "in_progress", "nid": nid})
 
-        try:
-            task = threading.Thread(target=start_scraping_task, args=(novel_url, nid, site))
-            task.start()
-            background_tasks[nid] = task
-            progress_store[nid] = [0, ""]
-            return jsonify({"status": "started", "nid": nid})
-        except Exception as e:
-            return jsonify({"error": str(e)}), 400
+    try:
+        started = schedule_scraping_task(
+            novel_url, nid, site.name, engine=options.get('engine', FETCH_ENGINE), priority=PRIORITIES[priority],
+            user=get_request_user()
+        )
+        if not started:
+            return jsonify({"status": "queued", "nid": nid, "position": job_scheduler.position(nid)})
+        return jsonify({"status": "started", "nid": nid})
+    except Exception as e:
+        job_backend.release(nid)
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/refetch-missing/<nid>', methods=['POST'])
+def refetch_missing(nid):
+    # Runs the novel again. Chapters already in the chapter store are reused,
+    # so past the TOC check only the missing ones are requested.
+    site = sites.find(nid)
+    status = job_backend.get_status(nid) or {}
+    if site is None or status.get('state') == 'running':
+        return jsonify({"error": "Novel not found or still running"}), 404
+    if not status.get('missing'):
+        return jsonify({"error": "No chapters are missing"}), 409
+    return start_job(site, nid, request.get_json(silent=True) or {})
 
 @app.route('/progress/<nid>', methods=['GET'])
 def get_progress(nid):
-    progress = progress_store.get(nid, [-1])[0]
-    title = progress_store.get(nid, ['',''])[1]
-    return jsonify({"progress": progress, "title": title})
+    status = job_backend.get_status(nid) or {"progress": 0 if job_queue and job_queue.is_pending(nid) else -1, "title": ""}
+    status.pop('version', None)
+    return jsonify({**status, "changed": job_backend.get_changed(nid)})
+
+@app.route('/progress-stream/<nid>', methods=['GET'])
+def progress_stream(nid):
+    # Each open stream pins a server thread, so only a few are allowed at a
+    # time and each is closed after SSE_MAX_DURATION; EventSource reconnects
+    # on its own and the page falls back to polling /progress on a 503.
+    if not sse_streams.acquire(blocking=False):
+        return jsonify({"error": "Too many progress streams"}), 503
+
+    def generate():
+        yield 'retry: 3000\n\n'
+        deadline = time.monotonic() + SSE_MAX_DURATION
+        version = None
+        while time.monotonic() < deadline:
+            if version is None:
+                status = job_backend.get_status(nid)
+            else:
+                status = job_backend.wait_status(nid, version, max(min(SSE_KEEPALIVE, deadline - time.monotonic()), 0))
+            if status is None:
+                pending = job_queue is not None and job_queue.is_pending(nid)
+                yield f'event: progress\ndata: {json.dumps({"progress": 0 if pending else -1, "title": "", "state": "queued" if pending else "unknown"})}\n\n'
+                if not pending:
+                    return
+                time.sleep(WORKER_POLL_INTERVAL)
+                continue
+            if status['version'] == version:
+                yield ': keep-alive\n\n'
+                continue
+            version = status['version']
+            status['changed'] = job_backend.get_changed(nid)
+            yield f'event: progress\ndata: {json.dumps(status, ensure_ascii=False)}\n\n'
+            if status.get('state') in ('done', 'failed'):
+                return
+
+    # Released when the response is closed, which also happens when the
+    # generator never runs (HEAD, or a client gone before the first chunk).
+    response = Response(
+        stream_with_context(generate()), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(sse_streams.release)
+    return response
 
 @app.route('/download/<nid>', methods=['GET'])
 def download_novel(nid):
-    novel = novel_store[nid]
-    if novel:
-        buffer = io.BytesIO()
-        buffer.write(novel[0].encode('utf-8'))
-        buffer.seek(0)
-        return send_file(buffer, as_attachment=True, download_name=f'{novel[1]}.txt', mimetype='text/plain')
-    else:
-        return jsonify({"error": "Novel not found or scraping not completed"}), 404
+    output_format = request.args.get('format', 'txt')
+    if output_format != 'txt':
+        if output_format not in FORMATS:
+            return jsonify({"error": f"Unknown format: {output_format}"}), 400
+        source = get_novel_chapters(nid) if not job_backend.is_running(nid) else None
+        if source is None:
+            return jsonify({"error": "Novel not found or scraping not completed"}), 404
+        title, chapters = source
+        if output_format == 'epub':
+            body = iter_epub(title, chapters, source=get_novel_url(nid))
+        elif output_format == 'zip':
+            body = iter_chapter_zip(title, chapters, transform=ruby_formatter)
+        else:
+            body = iter_aozora(title, chapters)
+        mimetype, extension = FORMATS[output_format]
+        return Response(
+            stream_with_context(body), mimetype=mimetype,
+            headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(f'{title}.{extension}')}"}
+        )
 
-@app.route('/search', methods=['POST'])
-def search():
-    word = request.form.get('word', '')
-    checkedR18 = request.form.get('mode', 'search')
-    parody = request.form.get('parody', '')
-    type_value = request.form.get('type', '0')
+    novel = job_backend.get_result(nid)
+    if novel and os.path.exists(novel[0]):
+        # send_file streams the spooled file in blocks and answers Range
+        # requests with 206, so interrupted downloads can be resumed.
+        return send_file(
+            novel[0], as_attachment=True, download_name=f'{novel[1]}.txt',
+            mimetype='text/plain; charset=utf-8', conditional=True, max_age=0
+        )
+    archive = get_novel_archive(nid, create=False) if NOVEL_ARCHIVE and not job_backend.is_running(nid) else None
+    if archive is not None and archive.meta.get('finished_at'):
+        # The spooled .txt has been evicted; rebuild it from the archive.
+        return Response(
+            stream_with_context(stream_archive(archive)), mimetype='text/plain; charset=utf-8',
+            headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(archive.meta['title'] + '.txt')}"}
+        )
+    return jsonify({"error": "Novel not found or scraping not completed"}), 404
 
-    filter_params = ['rensai_s1', 'rensai_s2', 'rensai_s4', 'mozi2', 'mozi1', 'mozi2_all', 'mozi1_all', 'rate2', 'rate1', 
-                     'soupt2', 'soupt1', 'f2', 'f1', 're2', 're1', 'v2', 'v1', 
-                     'r2', 'r1', 't2', 't1', 'd2', 'd1']
+SEARCH_FILTER_PARAMS = [
+    'rensai_s1', 'rensai_s2', 'rensai_s4', 'mozi2', 'mozi1', 'mozi2_all', 'mozi1_all', 'rate2', 'rate1', 
+    'soupt2', 'soupt1', 'f2', 'f1', 're2', 're1', 'v2', 'v1', 
+    'r2', 'r1', 't2', 't1', 'd2', 'd1'
+]
 
+def get_search_params(form):
     url_params = {
-        'mode': checkedR18,
-        'word': word,
-        'gensaku': parody,
-        'type': type_value
+        'mode': form.get('mode', 'search'),
+        'word': form.get('word', ''),
+        'gensaku': form.get('parody', ''),
+        'type': form.get('type', '0')
     }
-
-    for param in filter_params:
-        value = request.form.get(param)
+    for param in SEARCH_FILTER_PARAMS:
+        value = form.get(param)
         if value:
             url_params[param] = value
+    return url_params
 
-    base_url = "https://syosetu.org/search/"
+def fetch_search_page(url_params, job='search'):
+    base_url = f"{HAMELN_BASE_URL}/search/"
     url = f"{base_url}?{urlencode(url_params)}"
-
     headers = {
         "User-Agent": get_random_user_agent(),
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
@@ -348,26 +892,205 @@ def search():
         "DNT": "1",
         "Upgrade-Insecure-Requests": "1"
     }
-    scraper = cloudscraper.create_scraper()
-    #with get_session() as session:
+    with scraper_pool.lease(url) as scraper:
+        response = rate_scheduler.get(
+            scraper, url, job=job, headers={**headers, "User-Agent": scraper.headers.get("User-Agent") or headers["User-Agent"]},
+            cookies={'over18':'off', 'list_num':'50'}
+        )
+    # An error page parses to no results, which would then be cached.
+    if response.status_code >= 400:
+        raise ValueError(f'{url}: HTTP {response.status_code}')
+    return html_parser.parse_search(response.text)
+
+def search_novels(url_params):
+    def fetch():
+        results = fetch_search_page(url_params)
+        if catalog:
+            catalog.put(results, url_params['mode'])
+        return results
+
+    return search_cache.get_or_fetch(get_search_key(url_params), fetch)
+
+def crawl_catalog(pages=CATALOG_CRAWL_PAGES):
+    # Walks the newest updates first and stops at the first page with nothing
+    # new, so a regular crawl costs a page or two. Requests go through the
+    # rate limiter as a low-priority job, after running downloads.
+    changed_total = 0
+    job_scheduler.register('catalog', priority=PRIORITIES['low'], remaining=pages)
+    try:
+        for page in range(1, pages + 1):
+            results = fetch_search_page({**get_search_params({}), 'page': str(page)}, job='catalog')
+            changed = catalog.put(results)
+            changed_total += changed
+            log(logging.INFO, 'catalog page crawled', page=page, results=len(results), changed=changed)
+            if not results or not changed:
+                break
+    finally:
+        job_scheduler.forget('catalog')
+    return changed_total
+
+def run_catalog_crawler():
+    while True:
+        try:
+            crawl_catalog()
+        except Exception as e:
+            log(logging.WARNING, 'catalog crawl failed', error=str(e))
+        time.sleep(CATALOG_CRAWL_INTERVAL)
+
+if catalog and CATALOG_CRAWL_INTERVAL > 0:
+    threading.Thread(target=run_catalog_crawler, daemon=True).start()
+
+@app.route('/search', methods=['POST'])
+def search():
     try:
-        sleep(random.uniform(2,4))
-        response = scraper.get(url, headers=headers, cookies={'over18':'off', 'list_num':'50'})
-        soup = BeautifulSoup(response.text, 'html.parser')
-        novels = soup.find_all('div', class_='section3')
-
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future_to_index = {executor.submit(parse_novel, novel): i for i, novel in enumerate(novels)}
-            results = [None] * len(novels)
-                
-            for future in concurrent.futures.as_completed(future_to_index):
-                index = future_to_index[future]
-                results[index] = future.result()
-
-        return jsonify({'results': results})
+        results, cache_status = search_novels(get_search_params(request.form))
+        response = jsonify({'results': results})
+        response.headers['X-Cache'] = cache_status.upper()
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/catalog', methods=['GET'])
+def search_catalog():
+    # Same parameters as /search, answered from novels seen in earlier
+    # searches and catalog crawls instead of a request to syosetu.org.
+    if catalog is None:
+        return jsonify({"error": "The catalog is disabled"}), 404
+    params = {**request.args.to_dict(), 'parody': request.args.get('parody', '')}
+    unsupported = get_unsupported_filters(params, SEARCH_FILTER_PARAMS)
+    if unsupported:
+        return jsonify({"error": f"Not available locally: {', '.join(unsupported)}"}), 400
+    try:
+        results, total = catalog.query(
+            params, limit=max(1, min(request.args.get('limit', 50, type=int), 200)),
+            offset=max(0, request.args.get('offset', 0, type=int))
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({'results': results, 'total': total})
+
+def run_batch_job(batch, novel_url, nid, site_name):
+    if not job_backend.claim(nid):
+        # Already being scraped by another request; follow that run instead.
+        batch['joined'].add(nid)
+        return
+    start_scraping_task(novel_url, nid, site_name, executor=batch_chapters)
+
+def get_batch_novel(batch, nid):
+    status = job_backend.get_status(nid) or {}
+    # Status left over from a run before this batch does not count.
+    current = status.get('state') == 'running' or nid in batch['joined'] or status.get('started_at', 0) >= batch['created_at']
+    if not current:
+        status = {}
+    return {
+        'nid': nid,
+        'title': status.get('title', ''),
+        'state': status.get('state', 'queued'),
+        'progress': max(status.get('progress', 0), 0),
+        'completed': status.get('completed', 0),
+        'total': status.get('total'),
+        'eta': status.get('eta'),
+        'errors': status.get('errors', [])[-1:]
+    }
+
+@app.route('/batch', methods=['POST'])
+def start_batch():
+    body = request.json or {}
+    urls = body.get('urls') or []
+    if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+        return jsonify({"error": "urls must be a list of URLs."}), 400
+    urls = list(urls)
+    if body.get('search') and not isinstance(body['search'], dict):
+        return jsonify({"error": "search must be an object of search parameters."}), 400
+    if body.get('search'):
+        try:
+            results, _ = search_novels(get_search_params(body['search']))
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+        urls += [result['link'] for result in results]
+
+    jobs, invalid = {}, []
+    for url in urls:
+        site, nid = sites.match(url)
+        if site is None:
+            invalid.append(url)
+        elif nid not in jobs:
+            jobs[nid] = (site.get_novel_url(nid), site.name)
+    if not jobs:
+        return jsonify({"error": "No valid novel URLs.", "invalid": invalid}), 400
+    if len(jobs) > BATCH_MAX_NOVELS:
+        return jsonify({"error": f"A batch can hold at most {BATCH_MAX_NOVELS} novels."}), 400
+
+    batch_id = uuid.uuid4().hex
+    batch = {'nids': list(jobs), 'created_at': time.time(), 'joined': {nid for nid in jobs if job_backend.is_running(nid)}}
+    batches[batch_id] = batch
+    for nid, (novel_url, site_name) in jobs.items():
+        if nid in batch['joined']:
+            continue
+        if job_queue is not None:
+            if job_queue.enqueue(nid, novel_url, site_name)[1]:
+                job_backend.set_queued(nid)
+        else:
+            batch_jobs.submit(run_batch_job, batch, novel_url, nid, site_name)
+    log(logging.INFO, 'batch started', batch_id=batch_id, novels=len(jobs), invalid=len(invalid))
+    return jsonify({"status": "started", "batch_id": batch_id, "nids": list(jobs), "invalid": invalid})
+
+@app.route('/batch/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    batch = batches.get(batch_id)
+    if batch is None:
+        return jsonify({"error": "Batch not found"}), 404
+    novels = [get_batch_novel(batch, nid) for nid in batch['nids']]
+    counts = {state: sum(novel['state'] == state for novel in novels) for state in ('queued', 'running', 'done', 'failed')}
+    return jsonify({
+        "batch_id": batch_id,
+        "state": 'running' if counts['queued'] or counts['running'] else 'done' if not counts['failed'] else 'partial',
+        "progress": sum(novel['progress'] for novel in novels) // len(novels),
+        **counts,
+        "novels": novels
+    })
+
+@app.route('/batch/<batch_id>/download', methods=['GET'])
+def download_batch(batch_id):
+    batch = batches.get(batch_id)
+    if batch is None:
+        return jsonify({"error": "Batch not found"}), 404
+    # Finished novels only; the rest can be fetched again once they are done.
+    novels = [nid for nid in batch['nids'] if get_batch_novel(batch, nid)['state'] == 'done']
+    if not novels:
+        return jsonify({"error": "No novel in this batch has finished yet"}), 404
+    return Response(
+        stream_with_context(iter_text_zip(filter(None, (get_novel_text(nid) for nid in novels)))), mimetype='application/zip',
+        headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(f'batch-{batch_id[:8]}.zip')}"}
+    )
+
+@app.route('/local-search', methods=['GET'])
+def local_search():
+    # Full-text search over the chapters already downloaded, not the site.
+    if search_index is None:
+        return jsonify({"error": "Local search is disabled"}), 404
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "Query is required"}), 400
+    started = time.perf_counter()
+    results = search_index.search(
+        query, nid=request.args.get('nid') or None,
+        limit=max(1, min(request.args.get('limit', 20, type=int), LOCAL_SEARCH_MAX_RESULTS))
+    )
+    return jsonify({"results": results, "took_ms": round((time.perf_counter() - started) * 1000, 1)})
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        **job_backend.stats(), 'chapter_store': chapter_store.stats(), 'search_cache': search_cache.stats(), 'scraper_pool': scraper_pool.stats(),
+        'queue': job_queue.stats() if job_queue else None, 'search_index': search_index.stats() if search_index else None,
+        'catalog': catalog.stats() if catalog else None, 'scheduler': job_scheduler.stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/manifest.json')
 def manifest():
     return send_from_directory('static', 'manifest.json')
@@ -381,4 +1104,17 @@ def sitemap():
     return send_from_directory('static', 'sitemap.xml')
 
 if __name__ == '__main__':
-    app.run(debug=False)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', choices=['web', 'worker', 'crawl'], default='web')
+    parser.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY)
+    args = parser.parse_args()
+    if args.command == 'worker':
+        if job_queue is None:
+            parser.error('the worker needs JOB_QUEUE=sqlite')
+        run_worker(args.concurrency)
+    elif args.command == 'crawl':
+        if catalog is None:
+            parser.error('the crawler needs CATALOG=1')
+        print(f'{crawl_catalog()} novels new or updated')
+    else:
+        app.run(debug=False)
\ No newline at end of file
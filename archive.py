@@ -0,0 +1,170 @@
+import hashlib, json, mmap, os, struct, threading, time, zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'HNA1'
+CODEC_NONE, CODEC_ZLIB, CODEC_ZSTD = 0, 1, 2
+# offset, compressed length, text length, codec, fetched_at, blake2b digest
+RECORD = struct.Struct('<QIIBd16s')
+
+
+def compress(data, codec):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=9).compress(data)
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, 9)
+    return data
+
+
+def decompress(data, codec):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    return data
+
+
+def get_text_hash(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+class NovelArchive:
+    # One novel as three files: <nid>.hna holds independently compressed
+    # chapter blocks and is only ever appended to, <nid>.hnx is a fixed-width
+    # index (record i describes chapter i+1) and <nid>.json holds metadata.
+    # Replacing a chapter appends a new block and rewrites its index record
+    # in place; compact() drops the superseded blocks.
+    def __init__(self, path, codec=None):
+        self.path = path
+        self.index_path = path[:-4] + '.hnx' if path.endswith('.hna') else path + '.hnx'
+        self.meta_path = path[:-4] + '.json' if path.endswith('.hna') else path + '.json'
+        self.codec = codec if codec is not None else CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+        self.lock = threading.Lock()
+        self.data_map = None
+        self.index_map = None
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        for file_path, header in ((path, MAGIC), (self.index_path, b'')):
+            if not os.path.exists(file_path):
+                with open(file_path, 'wb') as f:
+                    f.write(header)
+        self.meta = self._load_meta()
+
+    def __len__(self):
+        return os.path.getsize(self.index_path) // RECORD.size
+
+    def _load_meta(self):
+        try:
+            with open(self.meta_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'nid': None, 'title': '', 'chapter_count': 0, 'garbage': 0}
+
+    def set_meta(self, **meta):
+        with self.lock:
+            self.meta.update(meta)
+            tmp_path = f'{self.meta_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.meta, f, ensure_ascii=False)
+            os.replace(tmp_path, self.meta_path)
+
+    def _map(self, name, file_path, size):
+        # Files only grow between compactions, so a mapping is reused until a
+        # read falls past its end.
+        current = getattr(self, name)
+        if current is None or len(current) < size:
+            if current is not None:
+                current.close()
+            with open(file_path, 'rb') as f:
+                current = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(file_path) else None
+            setattr(self, name, current)
+        return current
+
+    def get_record(self, index):
+        end = (index + 1) * RECORD.size
+        if index < 0 or os.path.getsize(self.index_path) < end:
+            return None
+        index_map = self._map('index_map', self.index_path, end)
+        record = RECORD.unpack_from(index_map, index * RECORD.size)
+        return None if record[0] == 0 else record
+
+    def read_chapter(self, index):
+        with self.lock:
+            record = self.get_record(index)
+            if record is None:
+                return None
+            offset, length, _, codec, _, _ = record
+            data_map = self._map('data_map', self.path, offset + length)
+            return decompress(data_map[offset:offset + length], codec).decode('utf-8')
+
+    def put_chapter(self, index, text, fetched_at=None):
+        # Returns False without writing when the stored chapter is identical.
+        digest = get_text_hash(text)
+        with self.lock:
+            record = self.get_record(index)
+            if record is not None and record[5] == digest:
+                return False
+            raw = text.encode('utf-8')
+            block = compress(raw, self.codec) if raw else b''
+            with open(self.path, 'ab') as f:
+                offset = f.tell()
+                f.write(block)
+            with open(self.index_path, 'r+b') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() < index * RECORD.size:
+                    f.write(b'\0' * (index * RECORD.size - f.tell()))
+                f.seek(index * RECORD.size)
+                f.write(RECORD.pack(offset, len(block), len(raw), self.codec if raw else CODEC_NONE, fetched_at or time.time(), digest))
+            if record is not None:
+                self.meta['garbage'] = self.meta.get('garbage', 0) + record[1]
+            return True
+
+    def iter_chapters(self):
+        # Chapters no run has fetched read as ''.
+        for index in range(self.meta.get('chapter_count') or len(self)):
+            yield index, self.read_chapter(index) or ''
+
+    def iter_text(self, transform=None):
+        # Streams the same layout NovelSpool writes: non-empty chapters
+        # separated by a blank line.
+        written = False
+        for _, text in self.iter_chapters():
+            if text:
+                yield ('\n\n' if written else '') + (transform(text) if transform else text)
+                written = True
+
+    def compact(self):
+        with self.lock:
+            records = [self.get_record(index) for index in range(len(self))]
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            tmp_index_path = f'{self.index_path}.{os.getpid()}.tmp'
+            data_map = self._map('data_map', self.path, os.path.getsize(self.path))
+            with open(tmp_path, 'wb') as data, open(tmp_index_path, 'wb') as index:
+                data.write(MAGIC)
+                for record in records:
+                    if record is None:
+                        index.write(b'\0' * RECORD.size)
+                        continue
+                    offset, length = record[0], record[1]
+                    index.write(RECORD.pack(data.tell(), *record[1:]))
+                    data.write(data_map[offset:offset + length])
+            self.close()
+            os.replace(tmp_path, self.path)
+            os.replace(tmp_index_path, self.index_path)
+            self.meta['garbage'] = 0
+        self.set_meta()
+
+    def stats(self):
+        return {
+            'chapters': len(self),
+            'bytes': os.path.getsize(self.path) + os.path.getsize(self.index_path),
+            'garbage': self.meta.get('garbage', 0)
+        }
+
+    def close(self):
+        for name in ('data_map', 'index_map'):
+            if getattr(self, name) is not None:
+                getattr(self, name).close()
+                setattr(self, name, None)
@@ -0,0 +1,55 @@
+import asyncio, contextlib, threading
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncResponse:
+    def __init__(self, status_code, text, headers):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers
+
+
+class AsyncSession:
+    def __init__(self, session):
+        self.session = session
+
+    async def get(self, url, headers=None, cookies=None):
+        async with self.session.get(url, headers=headers, cookies=cookies) as response:
+            return AsyncResponse(response.status, await response.text(errors='replace'), response.headers)
+
+
+class AsyncEngine:
+    def __init__(self, limit_per_host=8):
+        self.limit_per_host = limit_per_host
+        self.loop = None
+        self.lock = threading.Lock()
+
+    @property
+    def available(self):
+        return aiohttp is not None
+
+    def get_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name='async-engine', daemon=True).start()
+            return self.loop
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.get_loop())
+
+    @contextlib.asynccontextmanager
+    async def session(self, scraper):
+        # Reuse the User-Agent and cookies (cf_clearance etc.) the cloudscraper
+        # session obtained, so Cloudflare accepts the aiohttp requests too.
+        connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host)
+        async with aiohttp.ClientSession(
+            headers={'User-Agent': scraper.headers.get('User-Agent', '')},
+            cookies=scraper.cookies.get_dict(),
+            connector=connector
+        ) as session:
+            yield AsyncSession(session)
@@ -0,0 +1,124 @@
+import argparse, collections, hashlib, json, os, random, re, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+TOC_PATH = re.compile(r'^/novel/(\d+)/$')
+CHAPTER_PATH = re.compile(r'^/novel/(\d+)/(\d+)\.html$')
+CHALLENGE_PAGE = (
+    '<!DOCTYPE html><html><head><title>Just a moment...</title></head>'
+    '<body><div id="challenge-platform"></div></body></html>'
+)
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, f'{name}.html'), encoding='utf-8') as f:
+        return f.read().encode('utf-8')
+
+
+class FakeHameln(ThreadingHTTPServer):
+    # Stand-in for syosetu.org serving the recorded fixtures: every novel has
+    # the chapters listed in toc.html and every chapter is chapter.html. Each
+    # response is delayed by about `latency` seconds and, with the given
+    # probabilities, replaced by a Cloudflare challenge (403), a 429 or a 500.
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, error_rate=0.0, throttle_rate=0.0, challenge_rate=0.0, retry_after=1.0, seed=None):
+        super().__init__(address, FakeHamelnHandler)
+        self.pages = {name: load_fixture(name) for name in ('toc', 'chapter', 'search')}
+        self.etags = {name: f'"{hashlib.sha1(page).hexdigest()}"' for name, page in self.pages.items()}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.challenge_rate = challenge_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def count(self, kind, status):
+        with self.lock:
+            self.counters[f'{kind}_requests'] += 1
+            self.counters[f'status_{status}'] += 1
+
+    def roll(self):
+        with self.lock:
+            value = self.random.random()
+            delay = self.latency * self.random.uniform(0.5, 1.5)
+        return value, delay
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class FakeHamelnHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        path = urlsplit(self.path).path
+        if path == '/__stats':
+            self.send(200, json.dumps(server.stats()).encode('utf-8'), {'Content-Type': 'application/json'})
+            return
+        kind = 'toc' if TOC_PATH.match(path) else 'chapter' if CHAPTER_PATH.match(path) else 'search' if path == '/search/' else None
+        if kind is None:
+            server.count('other', 404)
+            self.send(404)
+            return
+
+        value, delay = server.roll()
+        time.sleep(delay)
+        if value < server.challenge_rate:
+            server.count(kind, 403)
+            self.send(403, CHALLENGE_PAGE.encode('utf-8'), {'Content-Type': 'text/html', 'cf-mitigated': 'challenge'})
+        elif value < server.challenge_rate + server.throttle_rate:
+            server.count(kind, 429)
+            self.send(429, b'Too Many Requests', {'Retry-After': str(server.retry_after)})
+        elif value < server.challenge_rate + server.throttle_rate + server.error_rate:
+            server.count(kind, 500)
+            self.send(500, b'Internal Server Error')
+        elif self.headers.get('If-None-Match') == server.etags[kind]:
+            server.count(kind, 304)
+            self.send(304, headers={'ETag': server.etags[kind]})
+        else:
+            server.count(kind, 200)
+            self.send(200, server.pages[kind], {'Content-Type': 'text/html; charset=utf-8', 'ETag': server.etags[kind]})
+
+
+def serve(port=0, ready=None, **options):
+    server = FakeHameln(('127.0.0.1', port), **options)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Local stand-in for syosetu.org serving the bench fixtures.')
+    arg_parser.add_argument('--port', type=int, default=8765)
+    arg_parser.add_argument('--latency', type=float, default=0.05, help='mean response delay in seconds')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0)
+    arg_parser.add_argument('--throttle-rate', type=float, default=0.0)
+    arg_parser.add_argument('--challenge-rate', type=float, default=0.0)
+    arg_parser.add_argument('--retry-after', type=float, default=1.0)
+    args = arg_parser.parse_args()
+    print(f'Serving on http://127.0.0.1:{args.port} (set HAMELN_BASE_URL to use it)')
+    serve(
+        args.port, latency=args.latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+        challenge_rate=args.challenge_rate, retry_after=args.retry_after
+    )
+
+
+if __name__ == '__main__':
+    main()
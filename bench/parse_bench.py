@@ -0,0 +1,73 @@
+import argparse, json, multiprocessing, os, resource, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parsers, postprocess
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+PAGES = ['chapter', 'toc', 'search', 'narou_chapter', 'narou_toc']
+
+
+def parse_page(parser, kind, page):
+    if kind in ('chapter', 'narou_chapter'):
+        title_html, paragraphs = getattr(parser, f'parse_{kind}')(page)
+        return parsers.get_title_lines(title_html), postprocess.chapter_html_to_text(paragraphs)
+    return getattr(parser, f'parse_{kind}')(page)
+
+
+def measure(backend, kind, repeat, queue):
+    # Runs in a fresh process so ru_maxrss reflects this backend only.
+    page = open(os.path.join(FIXTURES, f'{kind}.html'), encoding='utf-8').read()
+    parser = parsers.get_parser(backend)
+    result = parse_page(parser, kind, page)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse_page(parser, kind, page)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    queue.put({
+        'backend': backend,
+        'page': kind,
+        'bytes': len(page.encode('utf-8')),
+        'median_ms': timings[len(timings) // 2] * 1000,
+        'min_ms': timings[0] * 1000,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'parse_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline,
+        'result': result
+    })
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Parse-time and memory benchmark for the HTML parser backends.')
+    arg_parser.add_argument('--repeat', type=int, default=50)
+    arg_parser.add_argument('--backend', action='append', choices=parsers.available_parsers())
+    arg_parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = arg_parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    rows = []
+    for kind in PAGES:
+        for backend in args.backend or parsers.available_parsers():
+            queue = context.Queue()
+            process = context.Process(target=measure, args=(backend, kind, args.repeat, queue))
+            process.start()
+            rows.append(queue.get())
+            process.join()
+
+    for kind in PAGES:
+        results = [row.pop('result') for row in rows if row['page'] == kind]
+        if any(result != results[0] for result in results):
+            print(f'warning: backends disagree on {kind}.html', file=sys.stderr)
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f'{"page":<14} {"backend":<12} {"median ms":>10} {"min ms":>8} {"peak RSS KiB":>13} {"parse RSS KiB":>14}')
+    for row in rows:
+        print(f'{row["page"]:<14} {row["backend"]:<12} {row["median_ms"]:>10.2f} {row["min_ms"]:>8.2f} {row["peak_rss_kb"]:>13} {row["parse_rss_kb"]:>14}')
+
+
+if __name__ == '__main__':
+    main()
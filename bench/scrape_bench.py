@@ -0,0 +1,212 @@
+import argparse, json, multiprocessing, os, resource, shutil, subprocess, sys, tempfile, threading, time
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_hameln
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def get_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class ChapterTimer:
+    # Wraps app.get_chapter_text(_async) to time each successful chapter
+    # attempt, rate-limiter wait included. Failed attempts are not recorded;
+    # they show up as retries.
+    def __init__(self, app):
+        self.timings = []
+        self.lock = threading.Lock()
+        fetch, fetch_async = app.get_chapter_text, app.get_chapter_text_async
+
+        def get_chapter_text(*args, **kwargs):
+            start = time.perf_counter()
+            text = fetch(*args, **kwargs)
+            self.record(time.perf_counter() - start)
+            return text
+
+        async def get_chapter_text_async(*args, **kwargs):
+            start = time.perf_counter()
+            text = await fetch_async(*args, **kwargs)
+            self.record(time.perf_counter() - start)
+            return text
+
+        app.get_chapter_text, app.get_chapter_text_async = get_chapter_text, get_chapter_text_async
+
+    def record(self, seconds):
+        with self.lock:
+            self.timings.append(seconds)
+
+    def take(self):
+        with self.lock:
+            timings, self.timings = self.timings, []
+        return timings
+
+
+def get_server_stats(base_url):
+    with urlopen(f'{base_url}/__stats') as response:
+        return json.loads(response.read())
+
+
+def diff_stats(before, after):
+    return {key: after[key] - before.get(key, 0) for key in sorted(after) if after[key] != before.get(key, 0)}
+
+
+def run_phase(name, app, timer, base_url, run):
+    server_before = get_server_stats(base_url)
+    cpu_before = get_cpu_time()
+    start = time.perf_counter()
+    result = run()
+    elapsed = time.perf_counter() - start
+    server = diff_stats(server_before, get_server_stats(base_url))
+    timings = timer.take()
+    return {
+        'phase': name,
+        'seconds': elapsed,
+        'cpu_seconds': get_cpu_time() - cpu_before,
+        'chapters': len(timings),
+        'chapters_per_sec': len(timings) / elapsed if elapsed and timings else None,
+        'chapter_p50_ms': percentile(timings, 0.5) * 1000 if timings else None,
+        'chapter_p99_ms': percentile(timings, 0.99) * 1000 if timings else None,
+        # Every chapter fetch makes one request; anything beyond that is a retry.
+        'retries': server.get('chapter_requests', 0) - len(timings),
+        'server': server,
+        **result
+    }
+
+
+def scrape(app, site, nids, engine, concurrency):
+    def scrape_one(nid):
+        if not app.job_backend.claim(nid):
+            return
+        try:
+            if engine == 'async':
+                app.async_engine.submit(app.get_novel_txt_async(site.get_novel_url(nid), nid, site)).result()
+            else:
+                app.get_novel_txt(site.get_novel_url(nid), nid, site)
+        finally:
+            app.job_backend.release(nid)
+
+    threads = [threading.Thread(target=lambda part=nids[i::concurrency]: [scrape_one(nid) for nid in part]) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {'novels': len(nids), 'errors': sum(len((app.job_backend.get_status(nid) or {}).get('errors', [])) for nid in nids)}
+
+
+def search(client, count):
+    timings = []
+    for i in range(count):
+        start = time.perf_counter()
+        response = client.post('/search', data={'word': f'bench {i}'})
+        timings.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            return {'searches': i, 'search_error': response.get_json().get('error')}
+    return {'searches': count, 'search_p50_ms': percentile(timings, 0.5) * 1000, 'search_p99_ms': percentile(timings, 0.99) * 1000}
+
+
+def download(client, nids, formats):
+    result = {}
+    for format in formats:
+        timings, size = [], 0
+        for nid in nids:
+            start = time.perf_counter()
+            response = client.get(f'/download/{nid}' + (f'?format={format}' if format != 'txt' else ''))
+            size += len(response.get_data())
+            timings.append(time.perf_counter() - start)
+        result[f'download_{format}_p50_ms'] = percentile(timings, 0.5) * 1000
+        result[f'download_{format}_bytes'] = size
+    return result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='End-to-end scrape, search and download benchmark against a local stand-in server.')
+    arg_parser.add_argument('--novels', type=int, default=2)
+    arg_parser.add_argument('--concurrency', type=int, default=1, help='novels scraped at once')
+    arg_parser.add_argument('--engine', choices=['thread', 'async'], default='thread')
+    arg_parser.add_argument('--searches', type=int, default=20)
+    arg_parser.add_argument('--latency', type=float, default=0.02, help='mean server response delay in seconds')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0)
+    arg_parser.add_argument('--throttle-rate', type=float, default=0.0)
+    arg_parser.add_argument('--challenge-rate', type=float, default=0.0)
+    arg_parser.add_argument('--retry-after', type=float, default=0.1)
+    arg_parser.add_argument('--rps', type=float, default=200, help='RATE_LIMIT_RPS/MAX_RPS for the run')
+    arg_parser.add_argument('--min-rps', type=float, default=20, help='RATE_LIMIT_MIN_RPS, the floor 429s and challenges back off to')
+    arg_parser.add_argument('--seed', type=int, default=1)
+    arg_parser.add_argument('--output', help='also write the JSON report to this file')
+    args = arg_parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    ready = context.Queue()
+    server = context.Process(target=fake_hameln.serve, kwargs={
+        'ready': ready, 'latency': args.latency, 'error_rate': args.error_rate, 'throttle_rate': args.throttle_rate,
+        'challenge_rate': args.challenge_rate, 'retry_after': args.retry_after, 'seed': args.seed
+    }, daemon=True)
+    server.start()
+    base_url = f'http://127.0.0.1:{ready.get()}'
+
+    # app reads its configuration at import time.
+    cache_dir = tempfile.mkdtemp(prefix='hameln-bench-')
+    os.environ.update({
+        'HAMELN_BASE_URL': base_url,
+        'CACHE_DIR': cache_dir,
+        'FETCH_ENGINE': args.engine,
+        'RATE_LIMIT_RPS': str(args.rps),
+        'RATE_LIMIT_MIN_RPS': str(args.min_rps),
+        'RATE_LIMIT_MAX_RPS': str(args.rps),
+        'RATE_LIMIT_BURST': str(max(int(args.rps), 1)),
+        'RATE_LIMIT_PENALTY': str(args.retry_after)
+    })
+    import app
+    timer = ChapterTimer(app)
+    site = app.sites.get('syosetu_org')
+    client = app.app.test_client()
+    nids = [str(100000 + i) for i in range(args.novels)]
+    if args.engine == 'async' and not app.async_engine.available:
+        arg_parser.error('the async engine needs aiohttp')
+
+    phases = [
+        run_phase('scrape_cold', app, timer, base_url, lambda: scrape(app, site, nids, args.engine, args.concurrency)),
+        # Same novels again: the TOC revalidates and cached chapters are reused.
+        run_phase('scrape_warm', app, timer, base_url, lambda: scrape(app, site, nids, args.engine, args.concurrency)),
+        run_phase('search', app, timer, base_url, lambda: search(client, args.searches)),
+        run_phase('download', app, timer, base_url, lambda: download(client, nids, ['txt', 'epub', 'zip', 'aozora']))
+    ]
+    report = {
+        'commit': get_commit(),
+        'options': vars(args),
+        'parser': type(app.html_parser.parser).__name__,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'phases': phases
+    }
+    server.terminate()
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
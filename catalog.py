@@ -0,0 +1,172 @@
+import json, os, re, sqlite3, threading, time
+from search_index import escape_like
+
+NID_PATTERN = re.compile(r'/novel/(\d+)/')
+
+# Search filters the catalog can answer from what search results show, as
+# (column, lower bound param, upper bound param). The others (words per
+# chapter, total score, comments, episodes, voters, dialogue ratio) are not
+# on the result page.
+RANGE_FILTERS = [
+    ('words', 'mozi2_all', 'mozi1_all'),
+    ('evaluation', 'rate2', 'rate1'),
+    ('favs', 'f2', 'f1'),
+    ('updated_at', 'd2', 'd1')
+]
+STATUS_FILTERS = {'rensai_s1': 'short', 'rensai_s2': 'serial', 'rensai_s4': 'complete'}
+# The search page's `type` sort orders that map onto a catalog column.
+SORT_ORDERS = {
+    '0': 'updated_at DESC', '1': 'updated_at ASC',
+    '4': 'evaluation DESC', '5': 'evaluation ASC',
+    '10': 'favs DESC', '11': 'favs ASC',
+    '20': 'words DESC', '21': 'words ASC'
+}
+
+
+def parse_number(text, type=int):
+    digits = re.sub(r'[^\d.]', '', text or '')
+    try:
+        return type(digits)
+    except ValueError:
+        return None
+
+
+def get_status(status):
+    return 'short' if status.startswith('短編') else 'complete' if status.startswith('完結') else 'serial'
+
+
+class NovelCatalog:
+    # Metadata of every novel seen in a search result, kept in SQLite so
+    # filter and sort changes can be answered without asking syosetu.org.
+    # The parsed result is stored as is; the columns beside it exist to be
+    # indexed and searched. Results are kept apart by search mode, so R18
+    # novels only answer R18 queries.
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS novels (
+                nid TEXT PRIMARY KEY,
+                mode TEXT NOT NULL DEFAULT 'search',
+                link TEXT NOT NULL,
+                title TEXT NOT NULL,
+                author TEXT NOT NULL,
+                description TEXT NOT NULL DEFAULT '',
+                parody TEXT NOT NULL,
+                status TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                words INTEGER,
+                evaluation REAL,
+                favs INTEGER,
+                result TEXT NOT NULL,
+                seen_at REAL NOT NULL
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS keywords (
+                nid TEXT NOT NULL,
+                keyword TEXT NOT NULL,
+                alert INTEGER NOT NULL,
+                PRIMARY KEY (nid, keyword)
+            )
+        ''')
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(novels)')}
+        if 'mode' not in columns:
+            self.conn.execute("ALTER TABLE novels ADD COLUMN mode TEXT NOT NULL DEFAULT 'search'")
+        if 'description' not in columns:
+            self.conn.execute("ALTER TABLE novels ADD COLUMN description TEXT NOT NULL DEFAULT ''")
+            self.conn.execute("UPDATE novels SET description = COALESCE(json_extract(result, '$.description'), '')")
+        for column in ('mode', 'parody', 'status', 'updated_at', 'words', 'evaluation', 'favs'):
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS novels_{column} ON novels ({column})')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS keywords_keyword ON keywords (keyword)')
+        self.conn.commit()
+
+    def put(self, results, mode='search'):
+        # Returns how many of the results were new or updated since last seen.
+        now = time.time()
+        changed = 0
+        with self.lock:
+            for result in results:
+                match = NID_PATTERN.search(result['link'])
+                if match is None:
+                    continue
+                nid = match.group(1)
+                row = self.conn.execute('SELECT updated_at FROM novels WHERE nid = ?', (nid,)).fetchone()
+                if row is None or row[0] != result['updated_day']:
+                    changed += 1
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO novels '
+                    '(nid, mode, link, title, author, description, parody, status, updated_at, words, evaluation, favs, result, seen_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        nid, mode, result['link'], result['title'], result['author'], result['description'],
+                        result['parody'], get_status(result['status']),
+                        result['updated_day'], parse_number(result['words']), parse_number(result['evaluation'], float),
+                        parse_number(result['favs']), json.dumps(result, ensure_ascii=False), now
+                    )
+                )
+                self.conn.execute('DELETE FROM keywords WHERE nid = ?', (nid,))
+                self.conn.executemany(
+                    'INSERT OR IGNORE INTO keywords (nid, keyword, alert) VALUES (?, ?, ?)',
+                    [(nid, keyword, 0) for keyword in result['keywords']] + [(nid, keyword, 1) for keyword in result['alert_keywords']]
+                )
+            self.conn.commit()
+        return changed
+
+    def query(self, params, limit=50, offset=0):
+        # params uses the /search form names; raises ValueError for filters
+        # and sort orders the catalog cannot answer.
+        conditions, values = ['mode = ?'], [params.get('mode') or 'search']
+        word = params.get('word', '')
+        for term in word.split():
+            conditions.append(
+                "(title LIKE ? ESCAPE '\\' OR author LIKE ? ESCAPE '\\' OR description LIKE ? ESCAPE '\\' "
+                'OR nid IN (SELECT nid FROM keywords WHERE keyword = ?))'
+            )
+            values += [f'%{escape_like(term)}%'] * 3 + [term]
+        if params.get('parody'):
+            conditions.append('parody = ?')
+            values.append(params['parody'])
+        if params.get('keyword'):
+            conditions.append('nid IN (SELECT nid FROM keywords WHERE keyword = ?)')
+            values.append(params['keyword'])
+        statuses = [status for param, status in STATUS_FILTERS.items() if params.get(param)]
+        if statuses:
+            conditions.append(f'status IN ({", ".join("?" * len(statuses))})')
+            values += statuses
+        for column, lower, upper in RANGE_FILTERS:
+            for param, operator in ((lower, '>='), (upper, '<=')):
+                value = params.get(param)
+                if not value:
+                    continue
+                if column == 'updated_at':
+                    value = value + (' 23:59' if operator == '<=' else '')
+                else:
+                    value = parse_number(value, float)
+                    if value is None:
+                        raise ValueError(f'{param} must be a number')
+                conditions.append(f'{column} {operator} ?')
+                values.append(value)
+        order = SORT_ORDERS.get(params.get('type') or '0')
+        if order is None:
+            raise ValueError(f'sort order {params["type"]} is not available locally')
+        where = f'WHERE {" AND ".join(conditions)}'
+        with self.lock:
+            total = self.conn.execute(f'SELECT COUNT(*) FROM novels {where}', values).fetchone()[0]
+            rows = self.conn.execute(
+                f'SELECT result FROM novels {where} ORDER BY {order}, nid LIMIT ? OFFSET ?', values + [limit, offset]
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows], total
+
+    def stats(self):
+        with self.lock:
+            novels, last_seen = self.conn.execute('SELECT COUNT(*), MAX(seen_at) FROM novels').fetchone()
+        return {'novels': novels, 'last_seen_at': last_seen}
+
+
+def get_unsupported_filters(params, filter_params):
+    supported = {param for _, lower, upper in RANGE_FILTERS for param in (lower, upper)} | set(STATUS_FILTERS)
+    return [param for param in filter_params if params.get(param) and param not in supported]
@@ -0,0 +1,214 @@
+import os, json, sqlite3, threading, time
+from archive import CODEC_NONE, CODEC_ZLIB, CODEC_ZSTD, compress, decompress, get_text_hash, zstandard
+
+
+class ChapterStore:
+    # Chapter text is stored content-addressed: each distinct text is one
+    # compressed row in bodies, counted by the chapters that reference it, so
+    # the same text under several nids or chapters is kept once. max_bytes
+    # applies to the compressed bodies actually stored.
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, max_age=30 * 24 * 3600, fresh_for=7 * 24 * 3600, codec=None):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fresh_for = fresh_for
+        self.codec = codec if codec is not None else CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+        self.lock = threading.Lock()
+        self.puts_since_evict = 0
+        self.evictions = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS chapters (
+                nid TEXT NOT NULL,
+                wasuu INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                updated_at TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                content_hash TEXT,
+                PRIMARY KEY (nid, wasuu)
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS bodies (
+                hash BLOB PRIMARY KEY,
+                data BLOB NOT NULL,
+                codec INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                stored_size INTEGER NOT NULL,
+                refs INTEGER NOT NULL
+            )
+        ''')
+        if 'body_hash' not in [row[1] for row in self.conn.execute('PRAGMA table_info(chapters)')]:
+            self.conn.execute('ALTER TABLE chapters ADD COLUMN body_hash BLOB')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS chapters_accessed ON chapters (accessed_at)')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS tocs (
+                nid TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                etag TEXT,
+                last_modified TEXT
+            )
+        ''')
+        self._migrate()
+        self.conn.commit()
+
+    def _migrate(self):
+        # Moves the inline text of chapters stored before bodies existed.
+        rows = self.conn.execute('SELECT nid, wasuu, text FROM chapters WHERE body_hash IS NULL').fetchall()
+        for nid, wasuu, text in rows:
+            self.conn.execute(
+                "UPDATE chapters SET text = '', body_hash = ? WHERE nid = ? AND wasuu = ?", (self._add_body(text), nid, wasuu)
+            )
+
+    def _add_body(self, text):
+        body_hash = get_text_hash(text)
+        if self.conn.execute('UPDATE bodies SET refs = refs + 1 WHERE hash = ?', (body_hash,)).rowcount == 0:
+            raw = text.encode('utf-8')
+            data, codec = compress(raw, self.codec), self.codec
+            if len(data) >= len(raw):
+                # Short texts can come out larger compressed.
+                data, codec = raw, CODEC_NONE
+            self.conn.execute(
+                'INSERT INTO bodies (hash, data, codec, size, stored_size, refs) VALUES (?, ?, ?, ?, ?, 1)',
+                (body_hash, data, codec, len(raw), len(data))
+            )
+        return body_hash
+
+    def _release_bodies(self, body_hashes):
+        self.conn.executemany('UPDATE bodies SET refs = refs - 1 WHERE hash = ?', [(body_hash,) for body_hash in body_hashes])
+        self.conn.execute('DELETE FROM bodies WHERE refs <= 0')
+
+    def get(self, nid, wasuu):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT bodies.data, bodies.codec, fetched_at, updated_at, etag, last_modified, content_hash '
+                'FROM chapters JOIN bodies ON bodies.hash = chapters.body_hash WHERE nid = ? AND wasuu = ?',
+                (nid, wasuu)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                'UPDATE chapters SET accessed_at = ? WHERE nid = ? AND wasuu = ?', (time.time(), nid, wasuu)
+            )
+            self.conn.commit()
+        return {
+            'text': decompress(row[0], row[1]).decode('utf-8'),
+            **dict(zip(('fetched_at', 'updated_at', 'etag', 'last_modified', 'content_hash'), row[2:]))
+        }
+
+    def is_fresh(self, chapter, updated_at=None):
+        if chapter is None:
+            return False
+        if updated_at is not None and chapter['updated_at'] is not None:
+            return chapter['updated_at'] == updated_at
+        return time.time() - chapter['fetched_at'] <= self.fresh_for
+
+    def get_updated_at(self, nid):
+        # Read-only, unlike get(): does not count as an access for eviction.
+        with self.lock:
+            return dict(self.conn.execute('SELECT wasuu, updated_at FROM chapters WHERE nid = ?', (nid,)).fetchall())
+
+    def put(self, nid, wasuu, text, updated_at=None, etag=None, last_modified=None, content_hash=None):
+        now = time.time()
+        with self.lock:
+            previous = self.conn.execute('SELECT body_hash FROM chapters WHERE nid = ? AND wasuu = ?', (nid, wasuu)).fetchone()
+            body_hash = self._add_body(text)
+            if previous is not None:
+                self._release_bodies([previous[0]])
+            self.conn.execute(
+                'INSERT OR REPLACE INTO chapters '
+                '(nid, wasuu, text, size, fetched_at, accessed_at, updated_at, etag, last_modified, content_hash, body_hash) '
+                "VALUES (?, ?, '', ?, ?, ?, ?, ?, ?, ?, ?)",
+                (nid, wasuu, len(text.encode('utf-8')), now, now, updated_at, etag, last_modified, content_hash, body_hash)
+            )
+            self.conn.commit()
+            self.puts_since_evict += 1
+            if self.puts_since_evict >= 100:
+                self._evict()
+
+    def touch(self, nid, wasuu, updated_at=None):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                'UPDATE chapters SET fetched_at = ?, accessed_at = ?, updated_at = COALESCE(?, updated_at) WHERE nid = ? AND wasuu = ?',
+                (now, now, updated_at, nid, wasuu)
+            )
+            self.conn.commit()
+
+    def get_toc(self, nid):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT title, updated_at, fetched_at, etag, last_modified FROM tocs WHERE nid = ?', (nid,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'title': row[0], 'updated_at': json.loads(row[1]), 'fetched_at': row[2], 'etag': row[3], 'last_modified': row[4]}
+
+    def put_toc(self, nid, title, updated_at, etag=None, last_modified=None):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO tocs (nid, title, updated_at, fetched_at, etag, last_modified) VALUES (?, ?, ?, ?, ?, ?)',
+                (nid, title, json.dumps(updated_at), time.time(), etag, last_modified)
+            )
+            self.conn.commit()
+
+    def evict(self):
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        self.puts_since_evict = 0
+        expired = self.conn.execute('SELECT nid, wasuu, body_hash FROM chapters WHERE fetched_at < ?', (time.time() - self.max_age,)).fetchall()
+        self._delete(expired)
+        total = self.conn.execute('SELECT COALESCE(SUM(stored_size), 0) FROM bodies').fetchone()[0]
+        if total > self.max_bytes:
+            # A body only frees space once its last reference is evicted.
+            excess = total - self.max_bytes
+            freed = 0
+            victims = []
+            released = {}
+            for nid, wasuu, body_hash, refs, stored_size in self.conn.execute(
+                'SELECT nid, wasuu, body_hash, refs, stored_size FROM chapters JOIN bodies ON bodies.hash = chapters.body_hash ORDER BY accessed_at'
+            ):
+                victims.append((nid, wasuu, body_hash))
+                released[body_hash] = released.get(body_hash, 0) + 1
+                if released[body_hash] == refs:
+                    freed += stored_size
+                if freed >= excess:
+                    break
+            self._delete(victims)
+        self.conn.commit()
+
+    def _delete(self, chapters):
+        self.conn.executemany('DELETE FROM chapters WHERE nid = ? AND wasuu = ?', [(nid, wasuu) for nid, wasuu, _ in chapters])
+        self._release_bodies([body_hash for _, _, body_hash in chapters])
+        self.evictions += len(chapters)
+
+    def stats(self):
+        # bytes is what is on disk; logical_bytes what the chapters would take
+        # stored one by one, uncompressed.
+        with self.lock:
+            chapters, logical = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM chapters').fetchone()
+            bodies, unique, stored = self.conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(stored_size), 0) FROM bodies'
+            ).fetchone()
+            return {
+                'chapters': chapters,
+                'bodies': bodies,
+                'bytes': stored,
+                'logical_bytes': logical,
+                'unique_bytes': unique,
+                'dedup_ratio': logical / unique if unique else 1.0,
+                'compression_ratio': unique / stored if stored else 1.0,
+                'bytes_saved': logical - stored,
+                'evictions': self.evictions
+            }
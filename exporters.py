@@ -0,0 +1,242 @@
+import html, io, re, time, uuid, zipfile
+from postprocess import AOZORA_RUBY_PATTERN, RubyFormatter
+
+FORMATS = {
+    'epub': ('application/epub+zip', 'epub'),
+    'zip': ('application/zip', 'zip'),
+    'aozora': ('text/plain; charset=utf-8', 'txt')
+}
+UNSAFE_FILENAME_PATTERN = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+# For headings where ruby markup cannot go: file names and TOC labels.
+strip_ruby = RubyFormatter('strip')
+
+
+def split_chapter(text):
+    # Stored chapters start with '# <part>\n## <chapter>\n\n' or
+    # '## <chapter>\n\n' (see handle_chapter_response).
+    part, heading = None, None
+    lines = text.split('\n')
+    index = 0
+    if index < len(lines) and lines[index].startswith('# '):
+        part = lines[index][2:]
+        index += 1
+    if index < len(lines) and lines[index].startswith('## '):
+        heading = lines[index][3:]
+        index += 1
+        if index < len(lines) and lines[index] == '':
+            index += 1
+    if heading is None and part is not None:
+        part, heading = None, part
+    return part, heading, '\n'.join(lines[index:]) if index else text
+
+
+def get_safe_filename(name):
+    return UNSAFE_FILENAME_PATTERN.sub('_', name).strip() or 'untitled'
+
+
+class StreamBuffer(io.RawIOBase):
+    # Write-only sink for ZipFile; the generators below hand out whatever has
+    # accumulated after each chapter. It is unseekable, so ZipFile writes
+    # sizes into data descriptors instead of seeking back.
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def iter_aozora(title, chapters):
+    # Aozora Bunko annotation style: ruby stays as ｜漢字《かんじ》 and the
+    # headings and page breaks become ［＃...］ annotations.
+    yield f'{title}\n\n'
+    current_part = None
+    written = False
+    for text in chapters:
+        if not text:
+            continue
+        part, heading, body = split_chapter(text)
+        lines = []
+        if written:
+            lines.append('［＃改ページ］')
+        written = True
+        if part and part != current_part:
+            lines.append(f'［＃大見出し］{part}［＃大見出し終わり］')
+            current_part = part
+        if heading:
+            lines.append(f'［＃中見出し］{heading}［＃中見出し終わり］')
+        yield '\n'.join(lines + ['', body, '']) + '\n'
+
+
+def iter_chapter_zip(title, chapters, transform=None):
+    stream = StreamBuffer()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for index, text in enumerate(chapters):
+            if not text:
+                continue
+            _, heading, _ = split_chapter(text)
+            name = f'{get_safe_filename(title)}/{index + 1:04d}_{get_safe_filename(strip_ruby(heading or ""))}.txt'
+            archive.writestr(name, transform(text) if transform else text)
+            yield stream.take()
+    yield stream.take()
+
+
+def to_xhtml(text):
+    text = html.escape(text, quote=False)
+    return AOZORA_RUBY_PATTERN.sub(r'<ruby>\1<rt>\2</rt></ruby>', text)
+
+
+def get_chapter_xhtml(title, headings, body):
+    paragraphs = ''.join(f'<p>{to_xhtml(line)}</p>\n' if line else '<p><br/></p>\n' for line in body.split('\n'))
+    heading_html = ''.join(f'<h{level}>{to_xhtml(heading)}</h{level}>\n' for level, heading in headings)
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="ja" lang="ja">\n'
+        f'<head><meta charset="utf-8"/><title>{html.escape(title)}</title>'
+        '<link rel="stylesheet" type="text/css" href="style.css"/></head>\n'
+        f'<body>\n{heading_html}{paragraphs}</body>\n</html>\n'
+    )
+
+
+def get_nav_points(toc):
+    # toc is [(href, part, heading)]; chapters sharing a part are nested
+    # under it, the way the # / ## headings nest in the .txt output.
+    entries = []
+    for href, part, heading in toc:
+        part = strip_ruby(part) if part else part
+        if part and (not entries or entries[-1][1] != part):
+            entries.append((href, part, []))
+        label = strip_ruby(heading or part or href)
+        if part:
+            entries[-1][2].append((href, label))
+        else:
+            entries.append((href, label, None))
+    return entries
+
+
+def get_nav_xhtml(title, toc):
+    items = []
+    for href, label, children in get_nav_points(toc):
+        nested = ''
+        if children:
+            nested = '<ol>' + ''.join(f'<li><a href="{href}">{html.escape(child)}</a></li>' for href, child in children) + '</ol>'
+        items.append(f'<li><a href="{href}">{html.escape(label)}</a>{nested}</li>\n')
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="ja" lang="ja">\n'
+        f'<head><meta charset="utf-8"/><title>{html.escape(title)}</title></head>\n'
+        f'<body><nav epub:type="toc" id="toc"><h1>目次</h1><ol>\n{"".join(items)}</ol></nav></body>\n</html>\n'
+    )
+
+
+def get_toc_ncx(title, identifier, toc):
+    points = []
+    order = 0
+    for href, label, children in get_nav_points(toc):
+        order += 1
+        parent_order = order
+        nested = ''
+        for child_href, child in children or []:
+            order += 1
+            nested += (
+                f'<navPoint id="np{order}" playOrder="{order}"><navLabel><text>{html.escape(child)}</text></navLabel>'
+                f'<content src="{child_href}"/></navPoint>'
+            )
+        points.append(
+            f'<navPoint id="np{parent_order}" playOrder="{parent_order}">'
+            f'<navLabel><text>{html.escape(label)}</text></navLabel><content src="{href}"/>{nested}</navPoint>\n'
+        )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+        f'<head><meta name="dtb:uid" content="{identifier}"/></head>\n'
+        f'<docTitle><text>{html.escape(title)}</text></docTitle>\n<navMap>\n{"".join(points)}</navMap>\n</ncx>\n'
+    )
+
+
+def get_content_opf(title, identifier, hrefs, source=None):
+    manifest = ''.join(f'<item id="c{i}" href="{href}" media-type="application/xhtml+xml"/>\n' for i, href in enumerate(hrefs))
+    spine = ''.join(f'<itemref idref="c{i}"/>\n' for i in range(len(hrefs)))
+    source_meta = f'<dc:source>{html.escape(source)}</dc:source>\n' if source else ''
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid" xml:lang="ja">\n'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+        f'<dc:identifier id="bookid">{identifier}</dc:identifier>\n'
+        f'<dc:title>{html.escape(title)}</dc:title>\n<dc:language>ja</dc:language>\n{source_meta}'
+        f'<meta property="dcterms:modified">{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}</meta>\n'
+        '</metadata>\n<manifest>\n'
+        '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>\n'
+        '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>\n'
+        '<item id="style" href="style.css" media-type="text/css"/>\n'
+        f'{manifest}</manifest>\n<spine toc="ncx">\n<itemref idref="nav" linear="no"/>\n{spine}</spine>\n</package>\n'
+    )
+
+
+EPUB_CONTAINER = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n'
+    '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>\n'
+    '</container>\n'
+)
+EPUB_STYLE = 'body { line-height: 1.8; } p { margin: 0; text-indent: 0; } h1, h2 { margin: 1em 0; }\n'
+
+
+def iter_epub(title, chapters, source=None):
+    # Chapters are written as soon as they are read; only the small TOC
+    # (href and headings per chapter) is kept for the nav, ncx and opf that
+    # go at the end of the archive.
+    identifier = f'urn:uuid:{uuid.uuid5(uuid.NAMESPACE_URL, source or title)}'
+    stream = StreamBuffer()
+    toc = []
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        archive.writestr('META-INF/container.xml', EPUB_CONTAINER)
+        archive.writestr('OEBPS/style.css', EPUB_STYLE)
+        yield stream.take()
+        for index, text in enumerate(chapters):
+            if not text:
+                continue
+            part, heading, body = split_chapter(text)
+            href = f'chapter{index + 1:05d}.xhtml'
+            headings = [(1, part)] if part and (not toc or toc[-1][1] != part) else []
+            if heading:
+                headings.append((2 if part else 1, heading))
+            archive.writestr(f'OEBPS/{href}', get_chapter_xhtml(strip_ruby(heading or title), headings, body))
+            toc.append((href, part, heading))
+            yield stream.take()
+        archive.writestr('OEBPS/nav.xhtml', get_nav_xhtml(title, toc))
+        archive.writestr('OEBPS/toc.ncx', get_toc_ncx(title, identifier, toc))
+        archive.writestr('OEBPS/content.opf', get_content_opf(title, identifier, [href for href, _, _ in toc], source))
+    yield stream.take()
+
+
+def iter_text_zip(novels):
+    # novels yields (title, chunks) with chunks an iterable of bytes; each
+    # novel becomes <title>.txt and is compressed as its chunks arrive.
+    stream = StreamBuffer()
+    names = set()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for title, chunks in novels:
+            base = get_safe_filename(title)
+            name, count = f'{base}.txt', 1
+            while name in names:
+                count += 1
+                name = f'{base} ({count}).txt'
+            names.add(name)
+            with archive.open(name, 'w') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    data = stream.take()
+                    if data:
+                        yield data
+            yield stream.take()
+    yield stream.take()
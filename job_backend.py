@@ -0,0 +1,306 @@
+import json, os, socket, sqlite3, threading, time
+from result_store import ResultStore
+
+MAX_ERRORS = 20
+# Upsert SET expression for a new detail that keeps the previous 'missing'
+# (see MemoryJobBackend._reset).
+KEEP_MISSING = '''CASE WHEN json_type(jobs.detail, '$.missing') IS NULL THEN excluded.detail
+    ELSE json_set(excluded.detail, '$.missing', json(json_extract(jobs.detail, '$.missing'))) END'''
+
+
+def remove_novel_file(nid, novel):
+    if novel and novel[0] and os.path.exists(novel[0]):
+        os.remove(novel[0])
+
+
+def get_novel_size(novel):
+    return os.path.getsize(novel[0]) if os.path.exists(novel[0]) else 0
+
+
+class MemoryJobBackend:
+    # Job state for a single process.
+    def __init__(self, ttl=None, max_items=None, max_bytes=None, spill_dir=None):
+        self.progress = ResultStore(ttl=ttl, max_items=max_items, spill_dir=spill_dir, name='progress')
+        self.novels = ResultStore(
+            ttl=ttl, max_items=max_items, max_bytes=max_bytes,
+            sizeof=get_novel_size, on_evict=remove_novel_file
+        )
+        self.changed = ResultStore(ttl=ttl, max_items=max_items, spill_dir=spill_dir, name='changed')
+        self.claims = {}
+        self.lock = threading.Lock()
+        self.updated = threading.Condition(self.lock)
+        self.version = 0
+
+    def _update(self, nid, progress=None, title=None, detail=None, error=None):
+        # Progress entries are [progress, title, detail, version]; callers hold self.lock.
+        current = self.progress.get(nid) or [0, '', {}, 0]
+        detail = {**current[2], **(detail or {})}
+        if error is not None:
+            detail['errors'] = (detail.get('errors', []) + [error])[-MAX_ERRORS:]
+        self.version += 1
+        self.progress[nid] = [
+            current[0] if progress is None else progress,
+            current[1] if title is None else title,
+            detail,
+            self.version
+        ]
+        self.updated.notify_all()
+
+    def claim(self, nid):
+        with self.lock:
+            if nid in self.claims:
+                return False
+            self.claims[nid] = time.time()
+            self._reset(nid, {'state': 'running', 'started_at': time.time()})
+        return True
+
+    def set_queued(self, nid):
+        # For jobs put on the job queue, so their status does not show the
+        # previous run until a worker claims them.
+        with self.lock:
+            if nid not in self.claims:
+                self._reset(nid, {'state': 'queued', 'queued_at': time.time()})
+
+    def _reset(self, nid, detail):
+        # Chapters the last run missed stay listed until a run finishes, so
+        # a refetch that fails early can be retried.
+        previous = self.progress.pop(nid)
+        if previous and 'missing' in previous[2]:
+            detail['missing'] = previous[2]['missing']
+        self._update(nid, 0, '', detail)
+
+    def release(self, nid):
+        with self.lock:
+            self.claims.pop(nid, None)
+            current = self.progress.get(nid)
+            self._update(nid, detail={'state': 'done' if current and current[0] >= 100 else 'failed'})
+
+    def heartbeat(self):
+        # Claims in one process never time out.
+        pass
+
+    def is_running(self, nid):
+        with self.lock:
+            return nid in self.claims
+
+    def set_progress(self, nid, progress, title, **detail):
+        with self.lock:
+            self._update(nid, progress, title, detail)
+
+    def add_error(self, nid, message):
+        with self.lock:
+            self._update(nid, error=message)
+
+    def get_progress(self, nid):
+        current = self.progress.get(nid)
+        return current[:2] if current else None
+
+    def get_status(self, nid):
+        current = self.progress.get(nid)
+        if current is None:
+            return None
+        return {'progress': current[0], 'title': current[1], **current[2], 'version': current[3]}
+
+    def wait_status(self, nid, version, timeout):
+        with self.lock:
+            self.updated.wait_for(lambda: (self.get_status(nid) or {}).get('version', version) != version, timeout)
+        return self.get_status(nid)
+
+    def set_changed(self, nid, changed):
+        self.changed[nid] = changed
+
+    def get_changed(self, nid):
+        return self.changed.get(nid, [])
+
+    def set_result(self, nid, path, title):
+        self.novels[nid] = [path, title]
+        self.set_progress(nid, 100, title)
+
+    def get_result(self, nid):
+        return self.novels.get(nid)
+
+    def stats(self):
+        with self.lock:
+            running = len(self.claims)
+        return {
+            'running': running,
+            'progress_store': self.progress.stats(),
+            'novel_store': self.novels.stats(),
+            'changed_store': self.changed.stats()
+        }
+
+
+class SqliteJobBackend:
+    # Job state shared by every worker process that opens the same database
+    # file. Claims are taken with a single conditional upsert, so only one
+    # process can own a nid at a time; a claim whose heartbeat is older than
+    # claim_timeout is considered abandoned and can be taken over.
+    def __init__(self, path, ttl=None, max_bytes=None, claim_timeout=600):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.claim_timeout = claim_timeout
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                nid TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                owner TEXT,
+                heartbeat REAL,
+                progress INTEGER NOT NULL DEFAULT 0,
+                title TEXT NOT NULL DEFAULT '',
+                changed TEXT,
+                detail TEXT NOT NULL DEFAULT '{}',
+                version INTEGER NOT NULL DEFAULT 0,
+                path TEXT,
+                size INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            )
+        ''')
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params)
+
+    def claim(self, nid):
+        now = time.time()
+        cursor = self.execute(f'''
+            INSERT INTO jobs (nid, state, owner, heartbeat, progress, title, detail, version, updated_at)
+            VALUES (?, 'running', ?, ?, 0, '', ?, 1, ?)
+            ON CONFLICT(nid) DO UPDATE SET
+                state = 'running', owner = excluded.owner, heartbeat = excluded.heartbeat, progress = 0,
+                detail = {KEEP_MISSING}, version = jobs.version + 1, updated_at = excluded.updated_at
+            WHERE jobs.state != 'running' OR jobs.heartbeat < ?
+        ''', (nid, self.owner, now, json.dumps({'state': 'running', 'started_at': now}), now, now - self.claim_timeout))
+        return cursor.rowcount == 1
+
+    def set_queued(self, nid):
+        # For jobs put on the job queue, so their status does not show the
+        # previous run until a worker claims them.
+        now = time.time()
+        self.execute(f'''
+            INSERT INTO jobs (nid, state, progress, title, detail, version, updated_at)
+            VALUES (?, 'queued', 0, '', ?, 1, ?)
+            ON CONFLICT(nid) DO UPDATE SET
+                state = 'queued', owner = NULL, progress = 0, title = '',
+                detail = {KEEP_MISSING}, version = jobs.version + 1, updated_at = excluded.updated_at
+            WHERE jobs.state != 'running' OR jobs.heartbeat < ?
+        ''', (nid, json.dumps({'state': 'queued', 'queued_at': now}), now, now - self.claim_timeout))
+
+    def release(self, nid):
+        self.execute(
+            "UPDATE jobs SET state = CASE WHEN progress < 100 THEN 'failed' ELSE 'done' END, owner = NULL, "
+            "detail = json_set(detail, '$.state', CASE WHEN progress < 100 THEN 'failed' ELSE 'done' END), "
+            "version = version + 1, updated_at = ? WHERE nid = ? AND owner = ?",
+            (time.time(), nid, self.owner)
+        )
+
+    def heartbeat(self):
+        # Keeps every claim this process holds alive, whether or not the job
+        # is making progress: one waiting for a scheduler slot or stalled
+        # behind an open circuit breaker is not abandoned.
+        now = time.time()
+        self.execute("UPDATE jobs SET heartbeat = ? WHERE state = 'running' AND owner = ?", (now, self.owner))
+
+    def is_running(self, nid):
+        row = self.execute(
+            "SELECT 1 FROM jobs WHERE nid = ? AND state = 'running' AND heartbeat >= ?",
+            (nid, time.time() - self.claim_timeout)
+        ).fetchone()
+        return row is not None
+
+    def set_progress(self, nid, progress, title, **detail):
+        now = time.time()
+        self.execute(
+            'UPDATE jobs SET progress = ?, title = ?, detail = json_patch(detail, ?), version = version + 1, '
+            'heartbeat = ?, updated_at = ? WHERE nid = ?',
+            (progress, title, json.dumps(detail), now, now, nid)
+        )
+
+    def add_error(self, nid, message):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT detail FROM jobs WHERE nid = ?', (nid,)).fetchone()
+                if row is not None:
+                    detail = json.loads(row[0])
+                    detail['errors'] = (detail.get('errors', []) + [message])[-MAX_ERRORS:]
+                    self.conn.execute(
+                        'UPDATE jobs SET detail = ?, version = version + 1 WHERE nid = ?', (json.dumps(detail), nid)
+                    )
+            finally:
+                self.conn.execute('COMMIT')
+
+    def get_progress(self, nid):
+        row = self.execute('SELECT progress, title FROM jobs WHERE nid = ?', (nid,)).fetchone()
+        return list(row) if row else None
+
+    def get_status(self, nid):
+        row = self.execute('SELECT progress, title, detail, version FROM jobs WHERE nid = ?', (nid,)).fetchone()
+        if row is None:
+            return None
+        return {'progress': row[0], 'title': row[1], **json.loads(row[2]), 'version': row[3]}
+
+    def wait_status(self, nid, version, timeout, poll_interval=0.5):
+        # Other processes write the row, so there is nothing to block on; poll.
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.get_status(nid)
+            if status is None or status['version'] != version or time.monotonic() >= deadline:
+                return status
+            time.sleep(poll_interval)
+
+    def set_changed(self, nid, changed):
+        self.execute('UPDATE jobs SET changed = ? WHERE nid = ?', (json.dumps(changed), nid))
+
+    def get_changed(self, nid):
+        row = self.execute('SELECT changed FROM jobs WHERE nid = ?', (nid,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else []
+
+    def set_result(self, nid, path, title):
+        now = time.time()
+        self.execute(
+            'UPDATE jobs SET path = ?, size = ?, title = ?, progress = 100, version = version + 1, heartbeat = ?, updated_at = ? '
+            'WHERE nid = ?',
+            (path, os.path.getsize(path), title, now, now, nid)
+        )
+        self.evict()
+
+    def get_result(self, nid):
+        row = self.execute('SELECT path, title, updated_at FROM jobs WHERE nid = ? AND path IS NOT NULL', (nid,)).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[2] > self.ttl):
+            return None
+        return [row[0], row[1]]
+
+    def evict(self):
+        victims = []
+        if self.ttl is not None:
+            victims += self.execute(
+                "SELECT nid, path FROM jobs WHERE state != 'running' AND updated_at < ?", (time.time() - self.ttl,)
+            ).fetchall()
+        if self.max_bytes is not None:
+            total = self.execute('SELECT COALESCE(SUM(size), 0) FROM jobs WHERE path IS NOT NULL').fetchone()[0]
+            for nid, path, size in self.execute(
+                "SELECT nid, path, size FROM jobs WHERE path IS NOT NULL AND state != 'running' ORDER BY updated_at"
+            ).fetchall():
+                if total <= self.max_bytes:
+                    break
+                victims.append((nid, path))
+                total -= size
+        for nid, path in victims:
+            self.execute("DELETE FROM jobs WHERE nid = ? AND state != 'running'", (nid,))
+            remove_novel_file(nid, [path])
+
+    def stats(self):
+        counts = dict(self.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        total = self.execute('SELECT COALESCE(SUM(size), 0) FROM jobs WHERE path IS NOT NULL').fetchone()[0]
+        return {
+            'running': counts.get('running', 0),
+            'done': counts.get('done', 0),
+            'failed': counts.get('failed', 0),
+            'bytes': total
+        }
@@ -0,0 +1,136 @@
+import os, socket, sqlite3, threading, time
+
+
+class JobQueue:
+    # Durable queue of scraping jobs shared by the web process and workers.
+    # A running job whose heartbeat is older than claim_timeout belongs to a
+    # worker that died and is handed out again. Jobs are claimed by priority,
+    # then by the fewest chapters to fetch (default_size when unknown), except
+    # that one queued for max_wait seconds goes first, like JobScheduler.
+    def __init__(self, path, claim_timeout=600, max_attempts=3, retry_delay=30, max_wait=60, default_size=100):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.claim_timeout = claim_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_wait = max_wait
+        self.default_size = default_size
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                nid TEXT NOT NULL,
+                url TEXT NOT NULL,
+                site TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                enqueued_at REAL NOT NULL,
+                claimed_by TEXT,
+                heartbeat REAL,
+                finished_at REAL,
+                error TEXT
+            )
+        ''')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(queue)')]
+        if 'priority' not in columns:
+            self.conn.execute('ALTER TABLE queue ADD COLUMN priority INTEGER NOT NULL DEFAULT 0')
+        if 'size' not in columns:
+            self.conn.execute('ALTER TABLE queue ADD COLUMN size INTEGER')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS queue_state ON queue (state, available_at, id)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS queue_nid ON queue (nid, state)')
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params)
+
+    def transaction(self, fn):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(self.conn)
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+            return result
+
+    def enqueue(self, nid, url, site, priority=0, size=None):
+        def insert(conn):
+            row = conn.execute(
+                "SELECT id FROM queue WHERE nid = ? AND state IN ('queued', 'running')", (nid,)
+            ).fetchone()
+            if row:
+                return row[0], False
+            now = time.time()
+            cursor = conn.execute(
+                "INSERT INTO queue (nid, url, site, state, available_at, enqueued_at, priority, size) VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)",
+                (nid, url, site, now, now, priority, size)
+            )
+            return cursor.lastrowid, True
+        return self.transaction(insert)
+
+    def claim_next(self, worker_id):
+        def claim(conn):
+            now = time.time()
+            row = conn.execute('''
+                SELECT id, nid, url, site FROM queue
+                WHERE (state = 'queued' AND available_at <= ?) OR (state = 'running' AND heartbeat < ?)
+                ORDER BY
+                    CASE WHEN enqueued_at <= ? THEN 0 ELSE 1 END,
+                    CASE WHEN enqueued_at <= ? THEN id END,
+                    priority DESC, COALESCE(size, ?), id
+                LIMIT 1
+            ''', (now, now - self.claim_timeout, now - self.max_wait, now - self.max_wait, self.default_size)).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE queue SET state = 'running', claimed_by = ?, heartbeat = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker_id, now, row[0])
+            )
+            return dict(zip(('id', 'nid', 'url', 'site'), row))
+        return self.transaction(claim)
+
+    def heartbeat(self, job_ids):
+        now = time.time()
+        for job_id in job_ids:
+            self.execute("UPDATE queue SET heartbeat = ? WHERE id = ? AND state = 'running'", (now, job_id))
+
+    def complete(self, job_id):
+        self.execute("UPDATE queue SET state = 'done', finished_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def retry_later(self, job_id, delay=None):
+        self.execute(
+            "UPDATE queue SET state = 'queued', claimed_by = NULL, attempts = attempts - 1, available_at = ? WHERE id = ?",
+            (time.time() + (self.retry_delay if delay is None else delay), job_id)
+        )
+
+    def fail(self, job_id, error):
+        def update(conn):
+            attempts = conn.execute('SELECT attempts FROM queue WHERE id = ?', (job_id,)).fetchone()[0]
+            if attempts < self.max_attempts:
+                conn.execute(
+                    "UPDATE queue SET state = 'queued', claimed_by = NULL, error = ?, available_at = ? WHERE id = ?",
+                    (error, time.time() + self.retry_delay * attempts, job_id)
+                )
+            else:
+                conn.execute(
+                    "UPDATE queue SET state = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                    (error, time.time(), job_id)
+                )
+        self.transaction(update)
+
+    def is_pending(self, nid):
+        return self.execute(
+            "SELECT 1 FROM queue WHERE nid = ? AND state IN ('queued', 'running')", (nid,)
+        ).fetchone() is not None
+
+    def stats(self):
+        counts = dict(self.execute('SELECT state, COUNT(*) FROM queue GROUP BY state').fetchall())
+        return {state: counts.get(state, 0) for state in ('queued', 'running', 'done', 'failed')}
+
+
+def get_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
@@ -0,0 +1,137 @@
+import collections, itertools, threading, time
+
+PRIORITIES = {'high': 1, 'normal': 0, 'low': -1}
+
+
+class JobScheduler:
+    # Runs scraping jobs, at most max_jobs at a time and at most
+    # max_jobs_per_user of them for any one user. Waiting jobs start by
+    # priority, then by the least remaining work, so a ten-chapter request
+    # does not queue behind a three-thousand-chapter archive; a job that has
+    # waited max_wait seconds goes first regardless, so big ones still move.
+    #
+    # rank(job) gives the same ordering to the per-host rate limiters for
+    # the requests of jobs that are already running; remaining work there is
+    # the chapter count still to fetch, reported with set_remaining().
+    def __init__(self, max_jobs=4, max_jobs_per_user=2, max_wait=60, default_size=100, interactive=('search', None)):
+        self.max_jobs = max_jobs
+        self.interactive = interactive
+        self.max_jobs_per_user = max_jobs_per_user
+        self.max_wait = max_wait
+        self.default_size = default_size
+        self.pending = []
+        self.running = {}
+        self.jobs = {}
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def submit(self, job_id, run, priority=0, size=None, user=None, on_finish=None):
+        # Returns True if the job started right away, False if it is waiting.
+        # on_finish() is called once the job's slot is freed, so whatever it
+        # releases (the job's claim) cannot be taken again before that.
+        job = {
+            'id': job_id, 'run': run, 'priority': priority, 'user': user, 'order': next(self.order),
+            'submitted_at': time.monotonic(), 'on_finish': on_finish,
+            'entry': {'priority': priority, 'remaining': size if size is not None else self.default_size}
+        }
+        with self.lock:
+            self.jobs[job_id] = job['entry']
+            self.pending.append(job)
+            self.counters['submitted'] += 1
+            started = self._dispatch()
+        return job_id in started
+
+    def _dispatch(self):
+        started = []
+        while len(self.running) < self.max_jobs:
+            job = self._next_job()
+            if job is None:
+                break
+            self.pending.remove(job)
+            self.running[job['id']] = job
+            started.append(job['id'])
+            threading.Thread(target=self._run, args=(job,), name=f'job-{job["id"]}', daemon=True).start()
+        return started
+
+    def _next_job(self):
+        users = collections.Counter(job['user'] for job in self.running.values() if job['user'] is not None)
+        eligible = [job for job in self.pending if job['user'] is None or users[job['user']] < self.max_jobs_per_user]
+        if not eligible:
+            return None
+        now = time.monotonic()
+        starved = [job for job in eligible if now - job['submitted_at'] >= self.max_wait]
+        if starved:
+            return min(starved, key=lambda job: job['order'])
+        return min(eligible, key=lambda job: (self.rank(job['id']), job['order']))
+
+    def _run(self, job):
+        # run() may return a future (async engine jobs); the slot is then
+        # freed when the future completes rather than by holding this thread.
+        # Its callbacks run on the thread completing it (an event loop), so
+        # finishing, and on_finish() with it, moves to a thread of its own.
+        result = None
+        try:
+            result = job['run']()
+        finally:
+            if hasattr(result, 'add_done_callback'):
+                result.add_done_callback(
+                    lambda _: threading.Thread(target=self._finish, args=(job,), name=f'job-{job["id"]}', daemon=True).start()
+                )
+            else:
+                self._finish(job)
+
+    def _finish(self, job):
+        with self.lock:
+            # A job of the same id submitted meanwhile keeps its entries.
+            if self.running.get(job['id']) is job:
+                del self.running[job['id']]
+            if self.jobs.get(job['id']) is job['entry']:
+                del self.jobs[job['id']]
+            self.counters['finished'] += 1
+            self._dispatch()
+        if job['on_finish'] is not None:
+            job['on_finish']()
+
+    def register(self, job_id, priority=0, remaining=None):
+        # For work outside submit() that should still be ranked, such as the
+        # catalog crawler; forget() it when done.
+        with self.lock:
+            self.jobs[job_id] = {'priority': priority, 'remaining': remaining if remaining is not None else self.default_size}
+
+    def set_remaining(self, job_id, remaining):
+        with self.lock:
+            self.jobs.setdefault(job_id, {'priority': 0, 'remaining': remaining})['remaining'] = remaining
+
+    def forget(self, job_id):
+        # For jobs that only reported remaining work (batches, queue workers).
+        with self.lock:
+            if job_id not in self.running and all(job['id'] != job_id for job in self.pending):
+                self.jobs.pop(job_id, None)
+
+    def rank(self, job_id):
+        # Lower ranks first. Interactive requests (searches) are small and
+        # someone is waiting on them, so they rank ahead of every job; any
+        # other unknown job ranks as a normal one of default size.
+        if job_id in self.interactive:
+            return (-float('inf'), 0)
+        job = self.jobs.get(job_id)
+        if job is None:
+            return (0, self.default_size)
+        return (-job['priority'], job['remaining'])
+
+    def position(self, job_id):
+        with self.lock:
+            if job_id in self.running:
+                return 0
+            ranked = sorted(self.pending, key=lambda job: (self.rank(job['id']), job['order']))
+            return next((i + 1 for i, job in enumerate(ranked) if job['id'] == job_id), None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'running': len(self.running),
+                'pending': len(self.pending),
+                'submitted': self.counters['submitted'],
+                'finished': self.counters['finished']
+            }
@@ -0,0 +1,171 @@
+import bisect, contextlib, json, logging, threading, time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    # Counters and gauges are either updated in place or given a collect()
+    # that returns the current value (or {label tuple: value}) each time
+    # /metrics is rendered, for numbers another component already keeps.
+    kind = None
+
+    def __init__(self, name, help, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        if self.collect is not None:
+            value = self.collect()
+            with self.lock:
+                self.values = value if isinstance(value, dict) else {(): value}
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.labels, key)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else format_value(bound)
+                    lines.append(f'{self.name}_bucket{format_labels(self.labels, key, [("le", le)])} {cumulative}')
+                lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}')
+                lines.append(f'{self.name}_count{format_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), collect=None):
+        return self.register(Counter(name, help, labels, collect))
+
+    def gauge(self, name, help, labels=(), collect=None):
+        return self.register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4.
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines += metric.render()
+            except Exception as e:
+                lines.append(f'# {metric.name} unavailable: {e}')
+        return '\n'.join(lines) + '\n'
+
+
+class TimedParser:
+    # Wraps an HTML parser backend so every parse_<page> call is observed in
+    # histogram under page=<page>.
+    def __init__(self, parser, histogram):
+        self.parser = parser
+        self.histogram = histogram
+
+    def __getattr__(self, name):
+        method = getattr(self.parser, name)
+        if not name.startswith('parse_'):
+            return method
+
+        def timed(*args, **kwargs):
+            with self.histogram.time(page=name[len('parse_'):]):
+                return method(*args, **kwargs)
+        return timed
+
+
+class StructuredFormatter(logging.Formatter):
+    # Fields passed as extra={'fields': {...}} are appended as key=value
+    # pairs, or the whole record is one JSON object per line with as_json.
+    def __init__(self, as_json=False):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        if self.as_json:
+            entry = {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+                'level': record.levelname.lower(),
+                'logger': record.name,
+                'message': record.getMessage(),
+                **fields
+            }
+            if record.exc_info:
+                entry['exception'] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        text = f'{record.levelname} {record.name}: {record.getMessage()}'
+        if fields:
+            text += ' ' + ' '.join(f'{name}={json.dumps(value, ensure_ascii=False, default=str)}' for name, value in fields.items())
+        if record.exc_info:
+            text += '\n' + self.formatException(record.exc_info)
+        return text
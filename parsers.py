@@ -0,0 +1,330 @@
+import html, os, re
+from bs4 import BeautifulSoup
+from postprocess import chapter_html_to_text
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:
+    lxml = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+    HTMLParser = None
+
+
+# Hameln writes 2020年01月01日(水) 12:00, Narou 2020/01/01 12:00.
+DATE_PATTERN = re.compile(r'(\d{4})[年/](\d{2})[月/](\d{2})日?(?:\(.\))? ?(\d{2}):(\d{2})')
+NAROU_WASUU_PATTERN = re.compile(r'/(\d+)/?$')
+PAGE_PATTERN = re.compile(r'[?&]p=(\d+)')
+BR_PATTERN = re.compile(r'<br\s*/?>', re.I)
+OUTER_TAG_PATTERN = re.compile(r'^<[^>]*>(.*)</[^>]*>$', re.S)
+
+
+def get_title_lines(title_html):
+    # Ruby is kept in the Aozora form chapter text is stored in, so the
+    # title follows RUBY_MODE along with the text when written out.
+    return [line for line in (chapter_html_to_text([part]).strip() for part in BR_PATTERN.split(title_html)) if line]
+
+
+def get_updated_at(date_text):
+    match = DATE_PATTERN.search(date_text or '')
+    return '{}-{}-{} {}:{}'.format(*match.groups()) if match else None
+
+
+def get_narou_wasuu(href):
+    match = NAROU_WASUU_PATTERN.search(href or '')
+    return int(match.group(1)) if match else None
+
+
+def get_last_page(href):
+    match = PAGE_PATTERN.search(href or '')
+    return int(match.group(1)) if match else 1
+
+
+def build_search_result(title, link, author_info, description, status, latest, updated_day, words, evaluation,
+                        all_keywords, alert_keywords, favs):
+    author_info = author_info.split('\n')
+    return {
+        'title': title,
+        'link': link,
+        'author': author_info[2][2:],
+        'parody': author_info[1].replace('原作：','').replace('オリジナル：',''),
+        'description': description,
+        'status': status,
+        'latest': latest,
+        'updated_day': f'{updated_day[:10]} {updated_day[10:]}',
+        'words': words.split(' ')[1],
+        'evaluation': evaluation.strip()[5:],
+        'alert_keywords': alert_keywords,
+        'keywords': [x for x in all_keywords if x not in alert_keywords],
+        'favs': favs.split('｜')[1][6:]
+    }
+
+
+class SoupParser:
+    name = 'html.parser'
+
+    def parse_chapter(self, page):
+        soup = BeautifulSoup(page, 'html.parser')
+        chapter_title_tags = soup.find(id='maind')
+        if chapter_title_tags.find('span', class_='alert_color'):
+            chapter_title_tag = chapter_title_tags.find_all('span')[2]
+        else:
+            chapter_title_tag = chapter_title_tags.find_all('span')[1]
+        paragraphs = [p.decode_contents() for p in soup.find(id='honbun').find_all('p')]
+        return chapter_title_tag.decode_contents(), paragraphs
+
+    def parse_toc(self, page):
+        soup = BeautifulSoup(page, 'html.parser')
+        title = soup.find('div', class_='ss').find('span', attrs={'itemprop':'name'}).text
+        updated_at = []
+        for link in soup.select('a[href^="./"]'):
+            row = link.find_parent('tr')
+            nobr = row.find('nobr') if row else None
+            revised = nobr.find('span', attrs={'title': True}) if nobr else None
+            updated_at.append(get_updated_at(revised['title'] if revised else nobr.get_text() if nobr else None))
+        return title, updated_at
+
+    def parse_narou_chapter(self, page):
+        soup = BeautifulSoup(page, 'html.parser')
+        subtitle = soup.find(class_='p-novel__title')
+        body = [div for div in soup.find_all('div', class_='p-novel__text')
+                if not {'p-novel__text--preface', 'p-novel__text--afterword'} & set(div['class'])]
+        return subtitle.decode_contents() if subtitle else '', [p.decode_contents() for div in body for p in div.find_all('p')]
+
+    def parse_narou_toc(self, page):
+        soup = BeautifulSoup(page, 'html.parser')
+        title = soup.find(class_='p-novel__title').text.strip()
+        chapters = []
+        group = None
+        for node in soup.select('div.p-eplist__chapter-title, div.p-eplist__sublist'):
+            if 'p-eplist__chapter-title' in node['class']:
+                group = node.text.strip()
+                continue
+            update = node.find(class_='p-eplist__update')
+            revised = update.find('span', attrs={'title': True}) if update else None
+            chapters.append((
+                get_narou_wasuu(node.find('a', class_='p-eplist__subtitle')['href']),
+                group,
+                get_updated_at(revised['title'] if revised else update.text if update else None)
+            ))
+        last = soup.select_one('a.c-pager__item--last')
+        return title, chapters, get_last_page(last['href'] if last else None)
+
+    def parse_search(self, page):
+        soup = BeautifulSoup(page, 'html.parser')
+        return [self.parse_novel(novel) for novel in soup.find_all('div', class_='section3')]
+
+    def parse_novel(self, novel):
+        alert_keywords = [x.text for x in novel.find('div', class_='all_keyword').find('span').find_all('a')]
+        return build_search_result(
+            novel.find('a').text,
+            novel.find('a').get('href'),
+            novel.find_all('div', class_='blo_title_sak')[-1].text,
+            novel.find('div', class_='blo_inword').text,
+            novel.find('div', class_='blo_wasuu_base').find('span').text,
+            novel.find('a', attrs={'title':'最新話へのリンク'}).text,
+            novel.find('div', attrs={'title':'最終更新日'}).text,
+            novel.find('div', attrs={'title': '総文字数'}).text,
+            novel.find('div', class_='blo_hyouka').text,
+            [x.text for x in novel.find('div', class_='all_keyword').find_all('a')],
+            alert_keywords,
+            novel.find_all('div', attrs={'style': 'background-color: transparent;'})[-1].text
+        )
+
+
+def has_class(name):
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+
+# BeautifulSoup's .text leaves out <rt>/<rp> strings, so the other backends do too.
+def text_content(element):
+    return ''.join(element.xpath('.//text()[not(ancestor::rt) and not(ancestor::rp)]'))
+
+
+class LxmlParser:
+    name = 'lxml'
+
+    def __init__(self):
+        self.html_parser = lxml.html.HTMLParser(encoding='utf-8')
+
+    def parse(self, page):
+        return lxml.html.fromstring(page.encode('utf-8'), parser=self.html_parser)
+
+    def inner_html(self, element):
+        text = html.escape(element.text, quote=False) if element.text else ''
+        return text + ''.join(etree.tostring(child, encoding='unicode', method='html') for child in element)
+
+    def parse_chapter(self, page):
+        root = self.parse(page)
+        maind = root.xpath('//*[@id="maind"]')[0]
+        spans = maind.xpath('.//span')
+        chapter_title_tag = spans[2] if maind.xpath(f'.//span[{has_class("alert_color")}]') else spans[1]
+        paragraphs = [self.inner_html(p) for p in root.xpath('//*[@id="honbun"]//p')]
+        return self.inner_html(chapter_title_tag), paragraphs
+
+    def parse_toc(self, page):
+        root = self.parse(page)
+        title = text_content(root.xpath(f'(//div[{has_class("ss")}])[1]//span[@itemprop="name"]')[0])
+        updated_at = []
+        for link in root.xpath('//a[starts-with(@href, "./")]'):
+            nobr = link.xpath('(ancestor::tr[1]//nobr)[1]')
+            revised = nobr[0].xpath('.//span[@title]') if nobr else []
+            updated_at.append(get_updated_at(revised[0].get('title') if revised else text_content(nobr[0]) if nobr else None))
+        return title, updated_at
+
+    def parse_narou_chapter(self, page):
+        root = self.parse(page)
+        subtitle = root.xpath(f'(//*[{has_class("p-novel__title")}])[1]')
+        paragraphs = root.xpath(
+            f'//div[{has_class("p-novel__text")} and not({has_class("p-novel__text--preface")}) '
+            f'and not({has_class("p-novel__text--afterword")})]//p'
+        )
+        return self.inner_html(subtitle[0]) if subtitle else '', [self.inner_html(p) for p in paragraphs]
+
+    def parse_narou_toc(self, page):
+        root = self.parse(page)
+        title = text_content(root.xpath(f'(//*[{has_class("p-novel__title")}])[1]')[0]).strip()
+        chapters = []
+        group = None
+        for node in root.xpath(f'//div[{has_class("p-eplist__chapter-title")} or {has_class("p-eplist__sublist")}]'):
+            if 'p-eplist__chapter-title' in node.get('class').split():
+                group = text_content(node).strip()
+                continue
+            update = node.xpath(f'.//*[{has_class("p-eplist__update")}]')
+            revised = update[0].xpath('.//span[@title]') if update else []
+            chapters.append((
+                get_narou_wasuu(node.xpath(f'.//a[{has_class("p-eplist__subtitle")}]')[0].get('href')),
+                group,
+                get_updated_at(revised[0].get('title') if revised else text_content(update[0]) if update else None)
+            ))
+        last = root.xpath(f'//a[{has_class("c-pager__item--last")}]')
+        return title, chapters, get_last_page(last[0].get('href') if last else None)
+
+    def parse_search(self, page):
+        root = self.parse(page)
+        return [self.parse_novel(novel) for novel in root.xpath(f'//div[{has_class("section3")}]')]
+
+    def parse_novel(self, novel):
+        def first(path):
+            return novel.xpath(f'({path})[1]')[0]
+
+        title_link = first('.//a')
+        return build_search_result(
+            text_content(title_link),
+            title_link.get('href'),
+            text_content(novel.xpath(f'.//div[{has_class("blo_title_sak")}]')[-1]),
+            text_content(first(f'.//div[{has_class("blo_inword")}]')),
+            text_content(first(f'.//div[{has_class("blo_wasuu_base")}]//span')),
+            text_content(first('.//a[@title="最新話へのリンク"]')),
+            text_content(first('.//div[@title="最終更新日"]')),
+            text_content(first('.//div[@title="総文字数"]')),
+            text_content(first(f'.//div[{has_class("blo_hyouka")}]')),
+            [text_content(x) for x in first(f'.//div[{has_class("all_keyword")}]').xpath('.//a')],
+            [text_content(x) for x in first(f'.//div[{has_class("all_keyword")}]//span').xpath('.//a')],
+            text_content(novel.xpath('.//div[@style="background-color: transparent;"]')[-1])
+        )
+
+
+class SelectolaxParser:
+    name = 'selectolax'
+
+    def inner_html(self, node):
+        return OUTER_TAG_PATTERN.sub(r'\1', node.html)
+
+    def parse_chapter(self, page):
+        tree = HTMLParser(page)
+        maind = tree.css_first('#maind')
+        spans = maind.css('span')
+        chapter_title_tag = spans[2] if maind.css_first('span.alert_color') else spans[1]
+        paragraphs = [self.inner_html(p) for p in tree.css('#honbun p')]
+        return self.inner_html(chapter_title_tag), paragraphs
+
+    def parse(self, page):
+        tree = HTMLParser(page)
+        tree.strip_tags(['rt', 'rp'])
+        return tree
+
+    def parse_toc(self, page):
+        tree = self.parse(page)
+        title = tree.css_first('div.ss').css_first('span[itemprop="name"]').text()
+        updated_at = []
+        for link in tree.css('a[href^="./"]'):
+            row = link.parent
+            while row is not None and row.tag != 'tr':
+                row = row.parent
+            nobr = row.css_first('nobr') if row is not None else None
+            revised = nobr.css_first('span[title]') if nobr is not None else None
+            updated_at.append(get_updated_at(
+                revised.attributes['title'] if revised is not None else nobr.text() if nobr is not None else None
+            ))
+        return title, updated_at
+
+    def parse_narou_chapter(self, page):
+        tree = HTMLParser(page)
+        subtitle = tree.css_first('.p-novel__title')
+        paragraphs = tree.css('div.p-novel__text:not(.p-novel__text--preface):not(.p-novel__text--afterword) p')
+        return self.inner_html(subtitle) if subtitle is not None else '', [self.inner_html(p) for p in paragraphs]
+
+    def parse_narou_toc(self, page):
+        tree = self.parse(page)
+        title = tree.css_first('.p-novel__title').text().strip()
+        chapters = []
+        group = None
+        for node in tree.css('div.p-eplist__chapter-title, div.p-eplist__sublist'):
+            if 'p-eplist__chapter-title' in node.attributes.get('class', '').split():
+                group = node.text().strip()
+                continue
+            update = node.css_first('.p-eplist__update')
+            revised = update.css_first('span[title]') if update is not None else None
+            chapters.append((
+                get_narou_wasuu(node.css_first('a.p-eplist__subtitle').attributes.get('href')),
+                group,
+                get_updated_at(
+                    revised.attributes['title'] if revised is not None else update.text() if update is not None else None
+                )
+            ))
+        last = tree.css_first('a.c-pager__item--last')
+        return title, chapters, get_last_page(last.attributes.get('href') if last is not None else None)
+
+    def parse_search(self, page):
+        return [self.parse_novel(novel) for novel in self.parse(page).css('div.section3')]
+
+    def parse_novel(self, novel):
+        title_link = novel.css_first('a')
+        return build_search_result(
+            title_link.text(),
+            title_link.attributes.get('href'),
+            novel.css('div.blo_title_sak')[-1].text(),
+            novel.css_first('div.blo_inword').text(),
+            novel.css_first('div.blo_wasuu_base span').text(),
+            novel.css_first('a[title="最新話へのリンク"]').text(),
+            novel.css_first('div[title="最終更新日"]').text(),
+            novel.css_first('div[title="総文字数"]').text(),
+            novel.css_first('div.blo_hyouka').text(),
+            [x.text() for x in novel.css('div.all_keyword a')],
+            [x.text() for x in novel.css_first('div.all_keyword span').css('a')],
+            novel.css('div[style="background-color: transparent;"]')[-1].text()
+        )
+
+
+PARSERS = {
+    'selectolax': SelectolaxParser if HTMLParser is not None else None,
+    'lxml': LxmlParser if lxml is not None else None,
+    'html.parser': SoupParser
+}
+
+
+def available_parsers():
+    return [name for name, parser in PARSERS.items() if parser is not None]
+
+
+def get_parser(name=None):
+    name = name or os.environ.get('HTML_PARSER', 'auto')
+    if name == 'auto':
+        name = available_parsers()[0]
+    if PARSERS.get(name) is None:
+        raise ValueError(f'HTML parser backend {name!r} is not available; choose from {available_parsers()}')
+    return PARSERS[name]()
@@ -0,0 +1,38 @@
+import html, re
+
+RUBY_MODES = ('strip', 'aozora', 'paren')
+RUBY_PATTERN = re.compile(r'<ruby\b[^>]*>(.*?)</ruby\s*>', re.S | re.I)
+RT_PATTERN = re.compile(r'<rt\b[^>]*>(.*?)</rt\s*>', re.S | re.I)
+RP_PATTERN = re.compile(r'<rp\b[^>]*>.*?</rp\s*>', re.S | re.I)
+TAG_PATTERN = re.compile(r'<[^>]*>')
+AOZORA_RUBY_PATTERN = re.compile(r'｜([^｜《》\n]+)《([^｜《》\n]*)》')
+AOZORA_REPLACEMENTS = {'strip': r'\1', 'paren': r'\1(\2)'}
+
+
+def ruby_to_aozora(match):
+    ruby = RP_PATTERN.sub('', match.group(1))
+    reading = TAG_PATTERN.sub('', ''.join(RT_PATTERN.findall(ruby)))
+    base = TAG_PATTERN.sub('', RT_PATTERN.sub('', ruby))
+    return f'｜{base}《{reading}》' if reading else base
+
+
+def chapter_html_to_text(paragraphs):
+    # Chapters are stored with Aozora-style ruby (｜漢字《かんじ》) so any ruby
+    # mode can be produced later without refetching. The paragraphs are
+    # joined first so each substitution is one pass over the whole chapter.
+    text = TAG_PATTERN.sub('', RUBY_PATTERN.sub(ruby_to_aozora, '\n'.join(paragraphs)))
+    return html.unescape(text) if '&' in text else text
+
+
+class RubyFormatter:
+    # Converts stored chapter text to the configured ruby mode while it is
+    # written out.
+    def __init__(self, mode='strip'):
+        if mode not in RUBY_MODES:
+            raise ValueError(f'Unknown ruby mode: {mode}')
+        self.mode = mode
+
+    def __call__(self, text):
+        if self.mode == 'aozora' or '《' not in text:
+            return text
+        return AOZORA_RUBY_PATTERN.sub(AOZORA_REPLACEMENTS[self.mode], text)
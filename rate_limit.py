@@ -0,0 +1,246 @@
+import asyncio, collections, itertools, threading, time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+
+class RateLimited(Exception):
+    pass
+
+
+def is_challenge(response=None, error=None):
+    if error is not None:
+        return 'cloudflare' in type(error).__name__.lower() or 'challenge' in str(error).lower()
+    if response is None or response.status_code not in (403, 429, 503):
+        return False
+    if response.headers.get('cf-mitigated') == 'challenge':
+        return True
+    text = response.text[:4096]
+    return 'Just a moment' in text or 'challenge-platform' in text or 'cf-chl' in text
+
+
+def get_retry_after(response):
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class HostLimiter:
+    # Waiting requests are served one per job in turn, or, given rank(job),
+    # lowest rank first, except that a job left waiting max_wait seconds
+    # since its last request is served next.
+    #
+    # After breaker_threshold failures in a row (errors, 5xx, throttling) the
+    # circuit opens and every job's requests to the host wait out a cooldown
+    # that doubles, up to breaker_max_cooldown, each time a single probe
+    # request fails again.
+    def __init__(self, rate=0.5, burst=2, min_rate=0.05, max_rate=2.0, increase=0.02, decrease=0.5, penalty=30, rank=None, max_wait=60,
+                 breaker_threshold=5, breaker_cooldown=30, breaker_max_cooldown=600):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.penalty = penalty
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.breaker_max_cooldown = breaker_max_cooldown
+        self.failures = 0
+        self.opened = 0
+        # Until this time the one probe request is out; bounded in case the
+        # probe never reports (a cancelled task).
+        self.probe_deadline = 0.0
+        self.rank = rank
+        self.max_wait = max_wait
+        self.queues = collections.OrderedDict()
+        self.served_at = {}
+        self.tickets = itertools.count()
+        self.cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _poll(self, job, ticket):
+        now = time.monotonic()
+        self._refill(now)
+        front_job = self._front_job(now)
+        front_queue = self.queues[front_job]
+        if front_job != job or front_queue[0] != ticket:
+            return 1.0 / self.rate
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if now < self.probe_deadline:
+            return 0.25
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        if self.opened:
+            self.probe_deadline = now + 60
+        front_queue.popleft()
+        self.served_at[job] = now
+        if front_queue:
+            self.queues.move_to_end(job)
+        else:
+            del self.queues[job]
+            del self.served_at[job]
+        return 0.0
+
+    def _front_job(self, now):
+        if self.rank is None:
+            return next(iter(self.queues))
+        starved = [job for job in self.queues if now - self.served_at[job] >= self.max_wait]
+        if starved:
+            return min(starved, key=self.served_at.get)
+        # min() keeps the first of equal ranks, which is round-robin order.
+        return min(self.queues, key=self.rank)
+
+    def _enqueue(self, job, ticket):
+        if job not in self.queues:
+            self.served_at[job] = time.monotonic()
+        self.queues.setdefault(job, collections.deque()).append(ticket)
+
+    def acquire(self, job=None):
+        with self.cond:
+            ticket = next(self.tickets)
+            self._enqueue(job, ticket)
+            while True:
+                delay = self._poll(job, ticket)
+                if delay <= 0:
+                    self.cond.notify_all()
+                    return
+                self.cond.wait(min(delay, 1.0))
+
+    async def acquire_async(self, job=None):
+        with self.cond:
+            ticket = next(self.tickets)
+            self._enqueue(job, ticket)
+        try:
+            while True:
+                with self.cond:
+                    delay = self._poll(job, ticket)
+                    if delay <= 0:
+                        self.cond.notify_all()
+                        return
+                await asyncio.sleep(min(delay, 0.25))
+        except BaseException:
+            with self.cond:
+                self._discard(job, ticket)
+                self.cond.notify_all()
+            raise
+
+    def _discard(self, job, ticket):
+        queue = self.queues.get(job)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self.queues[job]
+                del self.served_at[job]
+
+    def report(self, response=None, error=None):
+        throttled = is_challenge(response, error) or (
+            response is not None and response.status_code in (429, 503)
+        )
+        failed = throttled or error is not None or response.status_code >= 500
+        with self.cond:
+            if throttled:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                pause = get_retry_after(response)
+                self.blocked_until = max(self.blocked_until, time.monotonic() + (pause if pause is not None else self.penalty))
+                self.tokens = min(self.tokens, 0.0)
+            elif error is None and response.status_code < 400:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+            if failed:
+                self.failures += 1
+                if self.probe_deadline or self.failures >= self.breaker_threshold:
+                    cooldown = min(self.breaker_max_cooldown, self.breaker_cooldown * 2 ** self.opened)
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + cooldown)
+                    self.opened += 1
+            else:
+                self.failures = 0
+                self.opened = 0
+            self.probe_deadline = 0.0
+            self.cond.notify_all()
+        return throttled
+
+    def state(self):
+        with self.cond:
+            breaker = 'closed' if not self.opened else 'open' if time.monotonic() < self.blocked_until else 'half_open'
+            return {'rate': self.rate, 'breaker': breaker, 'failures': self.failures}
+
+
+class RateScheduler:
+    def __init__(self, observe=None, **limiter_options):
+        # observe(host, waited, elapsed, status, throttled) is called after
+        # every request; status is None when the request raised.
+        self.observe = observe
+        self.limiter_options = limiter_options
+        self.policies = {}
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def set_policy(self, host, **limiter_options):
+        # Overrides the default limiter options for one host; applies to
+        # limiters created afterwards.
+        with self.lock:
+            self.policies[host] = limiter_options
+
+    def get_limiter(self, url):
+        host = urlsplit(url).hostname or ''
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = HostLimiter(**{**self.limiter_options, **self.policies.get(host, {})})
+            return self.limiters[host]
+
+    def stats(self):
+        with self.lock:
+            limiters = dict(self.limiters)
+        return {host: limiter.state() for host, limiter in limiters.items()}
+
+    def _report(self, limiter, url, waited, started, response=None, error=None):
+        throttled = limiter.report(response=response, error=error)
+        if self.observe is not None:
+            self.observe(
+                urlsplit(url).hostname or '', waited, time.monotonic() - started,
+                response.status_code if response is not None else None, throttled
+            )
+        if throttled:
+            if error is not None:
+                raise RateLimited(f'{url}: {error}') from error
+            raise RateLimited(f'{url}: HTTP {response.status_code}')
+
+    def get(self, scraper, url, job=None, **kwargs):
+        limiter = self.get_limiter(url)
+        started = time.monotonic()
+        limiter.acquire(job)
+        waited, started = time.monotonic() - started, time.monotonic()
+        try:
+            response = scraper.get(url, **kwargs)
+        except Exception as e:
+            self._report(limiter, url, waited, started, error=e)
+            raise
+        self._report(limiter, url, waited, started, response=response)
+        return response
+
+    async def get_async(self, session, url, job=None, **kwargs):
+        limiter = self.get_limiter(url)
+        started = time.monotonic()
+        await limiter.acquire_async(job)
+        waited, started = time.monotonic() - started, time.monotonic()
+        try:
+            response = await session.get(url, **kwargs)
+        except Exception as e:
+            self._report(limiter, url, waited, started, error=e)
+            raise
+        self._report(limiter, url, waited, started, response=response)
+        return response
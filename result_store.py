@@ -0,0 +1,160 @@
+import collections, hashlib, os, pickle, sys, threading, time, zlib
+
+
+class ResultStore:
+    # Dict-like store with TTL and LRU eviction, an optional byte budget and
+    # optional compressed spill to disk for entries pushed out of memory.
+    # Stores sharing a spill_dir need distinct names, as spill files are
+    # named after the key alone.
+    def __init__(self, ttl=None, max_items=None, max_bytes=None, sizeof=None, spill_dir=None,
+                 on_evict=None, can_evict=None, sweep_interval=60, name=''):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or sys.getsizeof
+        self.spill_dir = spill_dir
+        self.on_evict = on_evict
+        self.can_evict = can_evict
+        self.sweep_interval = sweep_interval
+        self.entries = collections.OrderedDict()
+        self.spilled = {}
+        self.total_bytes = 0
+        self.last_sweep = time.monotonic()
+        self.lock = threading.RLock()
+        self.counters = collections.Counter()
+        if spill_dir:
+            self.spill_dir = os.path.join(spill_dir, str(os.getpid()), name)
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries) + len(self.spilled)
+
+    def get(self, key, default=None):
+        with self.lock:
+            now = time.monotonic()
+            entry = self.entries.get(key)
+            if entry is None and key in self.spilled:
+                entry = self._load_spilled(key)
+            if entry is None or self._expired(entry, now):
+                if entry is not None:
+                    self._remove(key, 'expirations')
+                self.counters['misses'] += 1
+                return default
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self._discard(key)
+            size = self.sizeof(value)
+            self.entries[key] = (value, size, time.monotonic())
+            self.total_bytes += size
+            self._enforce()
+
+    def pop(self, key, default=None):
+        with self.lock:
+            value = self.get(key, _missing)
+            if value is _missing:
+                return default
+            self._discard(key)
+            return value
+
+    def stats(self):
+        with self.lock:
+            return {
+                'items': len(self.entries),
+                'spilled_items': len(self.spilled),
+                'bytes': self.total_bytes,
+                'hits': self.counters['hits'],
+                'misses': self.counters['misses'],
+                'evictions': self.counters['evictions'],
+                'expirations': self.counters['expirations'],
+                'spills': self.counters['spills']
+            }
+
+    def _expired(self, entry, now):
+        return self.ttl is not None and now - entry[2] > self.ttl and self._evictable(entry[0])
+
+    def _evictable(self, value):
+        return self.can_evict is None or self.can_evict(value)
+
+    def _enforce(self):
+        now = time.monotonic()
+        if now - self.last_sweep >= self.sweep_interval:
+            self.last_sweep = now
+            for key in [key for key, entry in self.entries.items() if self._expired(entry, now)]:
+                self._remove(key, 'expirations')
+            for key in [key for key, (_, stored_at) in self.spilled.items() if self.ttl is not None and now - stored_at > self.ttl]:
+                self._remove(key, 'expirations')
+        for key in list(self.entries):
+            over_items = self.max_items is not None and len(self.entries) > self.max_items
+            over_bytes = self.max_bytes is not None and self.total_bytes > self.max_bytes
+            if not (over_items or over_bytes):
+                break
+            if not self._evictable(self.entries[key][0]):
+                continue
+            if self.spill_dir:
+                self._spill(key)
+            else:
+                self._remove(key, 'evictions')
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pickle.z')
+
+    def _spill(self, key):
+        value, size, stored_at = self.entries.pop(key)
+        self.total_bytes -= size
+        with open(self._spill_path(key), 'wb') as f:
+            f.write(zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+        self.spilled[key] = (size, stored_at)
+        self.counters['spills'] += 1
+
+    def _load_spilled(self, key):
+        size, stored_at = self.spilled.pop(key)
+        path = self._spill_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.loads(zlib.decompress(f.read()))
+        except OSError:
+            return None
+        os.remove(path)
+        entry = (value, size, stored_at)
+        self.entries[key] = entry
+        self.total_bytes += size
+        self._enforce()
+        return entry
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+        if key in self.spilled:
+            del self.spilled[key]
+            path = self._spill_path(key)
+            if os.path.exists(path):
+                os.remove(path)
+        return entry
+
+    def _remove(self, key, counter):
+        entry = self._discard(key)
+        self.counters[counter] += 1
+        if self.on_evict is not None and entry is not None:
+            self.on_evict(key, entry[0])
+
+
+_missing = object()
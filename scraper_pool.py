@@ -0,0 +1,158 @@
+import collections, contextlib, json, os, threading, time
+from urllib.parse import urlsplit
+
+
+class PooledScraper:
+    # A cloudscraper session on loan from ScraperPool. Everything except get()
+    # is passed straight through to the session.
+    def __init__(self, scraper):
+        self.scraper = scraper
+        self.created_at = time.monotonic()
+        self.released_at = self.created_at
+        self.uses = 0
+        self.failures = 0
+
+    def __getattr__(self, name):
+        return getattr(self.scraper, name)
+
+    def get(self, url, **kwargs):
+        self.uses += 1
+        try:
+            response = self.scraper.get(url, **kwargs)
+        except Exception:
+            self.failures += 1
+            raise
+        # Consecutive failures mark the session as broken; one good response
+        # clears them again.
+        self.failures = self.failures + 1 if response.status_code in (403, 429, 503) else 0
+        return response
+
+
+class ScraperPool:
+    # Long-lived cloudscraper sessions per host, so keep-alive connections and
+    # Cloudflare clearance survive from one job to the next. Idle sessions are
+    # recycled once they are too old, too heavily used, have been idle long
+    # enough for the server to drop their connections, or keep failing. The
+    # clearance cookies and the User-Agent they are bound to are kept per host
+    # (and in cookie_dir, if given) and handed to every replacement session.
+    def __init__(self, create, size=2, max_age=1800, max_uses=1000, idle_timeout=300, max_failures=3,
+                 connections=8, cookie_dir=None):
+        self.create = create
+        self.size = size
+        self.max_age = max_age
+        self.max_uses = max_uses
+        self.idle_timeout = idle_timeout
+        self.max_failures = max_failures
+        self.connections = connections
+        self.cookie_dir = cookie_dir
+        self.idle = collections.defaultdict(list)
+        self.identities = {}
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        if cookie_dir:
+            os.makedirs(cookie_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def lease(self, url):
+        host = urlsplit(url).hostname or ''
+        scraper = self._take(host)
+        try:
+            yield scraper
+        finally:
+            self._give(host, scraper)
+
+    def warm(self, url, fetch):
+        # Solve the challenge for a host ahead of the first job that needs it.
+        with self.lease(url) as scraper:
+            fetch(scraper, url)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'idle': {host: len(scrapers) for host, scrapers in self.idle.items()},
+                'created': self.counters['created'],
+                'reused': self.counters['reused'],
+                'recycled': self.counters['recycled']
+            }
+
+    def _take(self, host):
+        with self.lock:
+            while self.idle[host]:
+                scraper = self.idle[host].pop()
+                if self._healthy(scraper, idle=True):
+                    self.counters['reused'] += 1
+                    return scraper
+                self._close(scraper)
+            self.counters['created'] += 1
+            identity = self._load_identity(host)
+        return self._new_scraper(identity)
+
+    def _give(self, host, scraper):
+        identity = {
+            'user_agent': scraper.headers.get('User-Agent', ''),
+            'cookies': [
+                {'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path, 'expires': c.expires}
+                for c in scraper.cookies
+            ]
+        }
+        with self.lock:
+            if scraper.failures == 0:
+                self._save_identity(host, identity)
+            scraper.released_at = time.monotonic()
+            if len(self.idle[host]) < self.size and self._healthy(scraper):
+                self.idle[host].append(scraper)
+                return
+            self._close(scraper)
+
+    def _healthy(self, scraper, idle=False):
+        now = time.monotonic()
+        if idle and now - scraper.released_at > self.idle_timeout:
+            return False
+        return (
+            now - scraper.created_at < self.max_age and
+            scraper.uses < self.max_uses and
+            scraper.failures < self.max_failures
+        )
+
+    def _close(self, scraper):
+        self.counters['recycled'] += 1
+        scraper.close()
+
+    def _new_scraper(self, identity):
+        scraper = self.create()
+        # Resize the keep-alive pools in place: cloudscraper's https adapter
+        # carries the TLS settings the challenge solve depends on.
+        for prefix in ('https://', 'http://'):
+            scraper.get_adapter(prefix).init_poolmanager(self.connections, self.connections)
+        if identity:
+            if identity.get('user_agent'):
+                scraper.headers['User-Agent'] = identity['user_agent']
+            now = time.time()
+            for cookie in identity.get('cookies', []):
+                if cookie.get('expires') is None or cookie['expires'] > now:
+                    scraper.cookies.set(
+                        cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'], expires=cookie['expires']
+                    )
+        return PooledScraper(scraper)
+
+    def _cookie_path(self, host):
+        return os.path.join(self.cookie_dir, f'{host}.json')
+
+    def _load_identity(self, host):
+        if host not in self.identities and self.cookie_dir and os.path.exists(self._cookie_path(host)):
+            try:
+                with open(self._cookie_path(host), encoding='utf-8') as f:
+                    self.identities[host] = json.load(f)
+            except (OSError, ValueError):
+                pass
+        return self.identities.get(host)
+
+    def _save_identity(self, host, identity):
+        if self.identities.get(host) == identity:
+            return
+        self.identities[host] = identity
+        if self.cookie_dir:
+            tmp_path = f'{self._cookie_path(host)}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(identity, f)
+            os.replace(tmp_path, self._cookie_path(host))
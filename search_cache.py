@@ -0,0 +1,59 @@
+import collections, concurrent.futures, threading
+from result_store import ResultStore
+
+
+class SearchCache:
+    # Parsed search results keyed on the normalized query. Concurrent misses
+    # for the same key share one upstream fetch; failures are not cached.
+    def __init__(self, ttl=None, max_items=None, spill_dir=None):
+        self.results = ResultStore(ttl=ttl, max_items=max_items, spill_dir=spill_dir, name='search')
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def get_or_fetch(self, key, fetch):
+        with self.lock:
+            results = self.results.get(key)
+            if results is not None:
+                self.counters['hits'] += 1
+                return results, 'hit'
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = concurrent.futures.Future()
+                self.counters['misses'] += 1
+            else:
+                self.counters['coalesced'] += 1
+        if not leader:
+            return future.result(), 'coalesced'
+        try:
+            results = fetch()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            self.results[key] = results
+            future.set_result(results)
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+        return results, 'miss'
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.counters['hits'],
+                'misses': self.counters['misses'],
+                'coalesced': self.counters['coalesced'],
+                'in_flight': len(self.in_flight),
+                'store': self.results.stats()
+            }
+
+
+def get_search_key(params):
+    # Parameter order, empty values and repeated whitespace in the search
+    # word do not change what syosetu.org returns.
+    return tuple(sorted(
+        (name, ' '.join(value.split()) if name == 'word' else value)
+        for name, value in params.items() if value
+    ))
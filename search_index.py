@@ -0,0 +1,181 @@
+import collections, hashlib, html, os, queue, re, sqlite3, threading
+from exporters import split_chapter
+from postprocess import RubyFormatter
+
+QUERY_PATTERN = re.compile(r'"([^"]+)"|(\S+)')
+strip_ruby = RubyFormatter('strip')
+
+
+def parse_query(query):
+    # Terms are ANDed. The trigram tokenizer can only match terms of three
+    # or more characters; shorter ones (common in Japanese) become LIKE
+    # filters, which are only fast alongside at least one longer term.
+    match_terms, like_terms = [], []
+    for phrase, word in QUERY_PATTERN.findall(query):
+        term = (phrase or word).strip()
+        if term:
+            (match_terms if len(term) >= 3 else like_terms).append(term)
+    return match_terms, like_terms
+
+
+def escape_like(term):
+    return re.sub(r'[\\%_]', lambda match: '\\' + match.group(), term)
+
+
+def mark(text):
+    return html.escape(text).replace('\x01', '<mark>').replace('\x02', '</mark>')
+
+
+def get_snippet(text, term, width=40):
+    position = text.find(term)
+    if position < 0:
+        return html.escape(text[:width * 2])
+    start = max(0, position - width)
+    snippet = text[start:position] + '\x01' + term + '\x02' + text[position + len(term):position + len(term) + width]
+    return ('…' if start else '') + mark(snippet.replace('\n', ' ')) + '…'
+
+
+class SearchIndex:
+    # SQLite FTS5 (trigram tokenizer) index over chapter text, written by a
+    # background thread so scraping only pays for a queue put. Chapters are
+    # indexed with ruby reduced to the base text, keyed on (nid, wasuu), and
+    # re-indexed only when their text changes.
+    def __init__(self, path, batch_size=100, max_queue=10000):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.counters = collections.Counter()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chapter_index USING fts5("
+            "heading, body, nid UNINDEXED, wasuu UNINDEXED, tokenize='trigram')"
+        )
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS indexed (
+                nid TEXT NOT NULL,
+                wasuu INTEGER NOT NULL,
+                row INTEGER NOT NULL,
+                text_hash TEXT NOT NULL,
+                PRIMARY KEY (nid, wasuu)
+            )
+        ''')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS novels (nid TEXT PRIMARY KEY, title TEXT NOT NULL)')
+        self.conn.commit()
+        threading.Thread(target=self._run, name='search-index', daemon=True).start()
+
+    def add_chapter(self, nid, wasuu, text):
+        self._put(('chapter', nid, wasuu, text))
+
+    def add_novel(self, nid, title, chapter_count, load_chapters):
+        # Records the title and indexes whatever chapters of the novel are
+        # not indexed yet; load_chapters() is only called if any are missing.
+        self._put(('novel', nid, title, chapter_count, load_chapters))
+
+    def _put(self, task):
+        try:
+            self.queue.put_nowait(task)
+        except queue.Full:
+            # add_novel at the end of the job picks up dropped chapters.
+            self.counters['dropped'] += 1
+
+    def _run(self):
+        while True:
+            tasks = [self.queue.get()]
+            while len(tasks) < self.batch_size:
+                try:
+                    tasks.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._index(tasks)
+            except Exception as e:
+                self.counters['errors'] += 1
+                self.last_error = str(e)
+
+    def _index(self, tasks):
+        chapters = []
+        for task in tasks:
+            if task[0] == 'chapter':
+                chapters.append(task[1:])
+                continue
+            _, nid, title, chapter_count, load_chapters = task
+            with self.lock:
+                self.conn.execute('INSERT OR REPLACE INTO novels (nid, title) VALUES (?, ?)', (nid, title))
+                self.conn.commit()
+                indexed = {row[0] for row in self.conn.execute('SELECT wasuu FROM indexed WHERE nid = ?', (nid,))}
+            if len(indexed) < chapter_count:
+                chapters += [
+                    (nid, index + 1, text) for index, text in enumerate(load_chapters())
+                    if index + 1 not in indexed and text
+                ]
+        for start in range(0, len(chapters), self.batch_size):
+            self._write(chapters[start:start + self.batch_size])
+
+    def _write(self, chapters):
+        with self.lock:
+            for nid, wasuu, text in chapters:
+                text_hash = hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+                row = self.conn.execute('SELECT row, text_hash FROM indexed WHERE nid = ? AND wasuu = ?', (nid, wasuu)).fetchone()
+                if row is not None and row[1] == text_hash:
+                    continue
+                if row is not None:
+                    self.conn.execute('DELETE FROM chapter_index WHERE rowid = ?', (row[0],))
+                part, heading, body = split_chapter(strip_ruby(text))
+                cursor = self.conn.execute(
+                    'INSERT INTO chapter_index (heading, body, nid, wasuu) VALUES (?, ?, ?, ?)',
+                    (' '.join(filter(None, (part, heading))), body, nid, wasuu)
+                )
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO indexed (nid, wasuu, row, text_hash) VALUES (?, ?, ?, ?)',
+                    (nid, wasuu, cursor.lastrowid, text_hash)
+                )
+                self.counters['indexed'] += 1
+            self.conn.commit()
+
+    def search(self, query, nid=None, limit=20):
+        match_terms, like_terms = parse_query(query)
+        if not match_terms and not like_terms:
+            return []
+        conditions, params = [], []
+        if match_terms:
+            conditions.append('chapter_index MATCH ?')
+            params.append(' AND '.join('"{}"'.format(term.replace('"', '""')) for term in match_terms))
+        for term in like_terms:
+            conditions.append("(heading LIKE ? ESCAPE '\\' OR body LIKE ? ESCAPE '\\')")
+            params += [f'%{escape_like(term)}%'] * 2
+        if nid is not None:
+            conditions.append('chapter_index.nid = ?')
+            params.append(nid)
+        snippet = "snippet(chapter_index, 1, '\x01', '\x02', '…', 24)" if match_terms else 'body'
+        order = 'ORDER BY bm25(chapter_index)' if match_terms else 'ORDER BY chapter_index.nid, wasuu'
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT chapter_index.nid, wasuu, novels.title, heading, {snippet} FROM chapter_index '
+                f'LEFT JOIN novels ON novels.nid = chapter_index.nid WHERE {" AND ".join(conditions)} {order} LIMIT ?',
+                params + [limit]
+            ).fetchall()
+        return [
+            {
+                'nid': row[0],
+                'wasuu': row[1],
+                'title': row[2] or '',
+                'heading': row[3],
+                'snippet': mark(row[4].replace('\n', ' ')) if match_terms else get_snippet(row[4], like_terms[0])
+            }
+            for row in rows
+        ]
+
+    def stats(self):
+        with self.lock:
+            chapters, novels = self.conn.execute('SELECT COUNT(*), COUNT(DISTINCT nid) FROM indexed').fetchone()
+        return {
+            'chapters': chapters,
+            'novels': novels,
+            'queued': self.queue.qsize(),
+            'indexed': self.counters['indexed'],
+            'dropped': self.counters['dropped'],
+            'errors': self.counters['errors']
+        }
@@ -0,0 +1,208 @@
+import collections, concurrent.futures, hashlib, json, random, re
+from urllib.parse import urlencode, urlsplit
+from parsers import get_title_lines
+
+# chapters is [(url, group)]; group is the chapter group heading when the TOC
+# knows it and the chapter page does not repeat it.
+Toc = collections.namedtuple('Toc', 'title chapters updated_at etag last_modified')
+
+
+def get_validator_headers(cached):
+    validator_headers = {}
+    if cached and cached.get('etag'):
+        validator_headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        validator_headers['If-Modified-Since'] = cached['last_modified']
+    return validator_headers
+
+
+class Site:
+    # What the shared fetch engine in app.py needs to know about one novel
+    # site. fetch(url, headers=None) is a rate-limited GET on the job's
+    # session that already carries the session headers and get_cookies(nid).
+    name = None
+    url_pattern = None
+    nid_pattern = None
+    honbun_pattern = None
+    title_pattern = None
+    referers = []
+    # Per-host overrides of the RateScheduler defaults, {host: {option: value}}.
+    rate_policy = {}
+
+    def __init__(self, parser):
+        self.parser = parser
+
+    def match(self, url):
+        match = self.url_pattern.search(url)
+        return match.group(1) if match else None
+
+    def owns(self, nid):
+        return self.nid_pattern.fullmatch(nid) is not None
+
+    def get_novel_url(self, nid):
+        raise NotImplementedError
+
+    def get_chapter_url(self, novel_url, index):
+        raise NotImplementedError
+
+    def get_referer(self):
+        return random.choice(self.referers)
+
+    def get_cookies(self, nid, wasuu=None):
+        return {}
+
+    def get_toc(self, fetch, novel_url, nid, cached, get_stored):
+        # Returns a Toc, or None when the cached TOC is still current.
+        # get_stored() gives {wasuu: updated_at} for chapters in the store.
+        raise NotImplementedError
+
+    def parse_chapter(self, page, group=None):
+        # Returns the heading lines (group first, if any) and the paragraph
+        # HTML of a chapter page.
+        raise NotImplementedError
+
+    def get_content_hash(self, page):
+        # Covers the chapter heading as well as the text, so a revision that
+        # only retitles a chapter is not taken for unchanged.
+        match = self.honbun_pattern.search(page)
+        if match is None:
+            return None
+        title = self.title_pattern.search(page) if self.title_pattern else None
+        payload = (title.group(1) if title else '') + '\0' + match.group(1)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class HamelnSite(Site):
+    name = 'syosetu_org'
+    nid_pattern = re.compile(r'\d+')
+    honbun_pattern = re.compile(r'<div[^>]*id="honbun"[^>]*>(.*?)</div>', re.S)
+    # The heading block above the text, which holds the chapter title.
+    title_pattern = re.compile(r'<div[^>]*id="maind"[^>]*>(.*?)<div[^>]*id="honbun"', re.S)
+    referers = [
+        "https://www.google.com/search?q=%E3%83%8F%E3%83%BC%E3%83%A1%E3%83%AB%E3%83%B3&ie=UTF-8&oe=UTF-8&hl=ja-jp&client=safari",
+        "https://syosetu.org/",
+        "https://syosetu.org/search/?mode=search",
+        "https://syosetu.org/?mode=rank",
+        "https://syosetu.org/?mode=favo"
+    ]
+
+    def __init__(self, parser, base_url='https://syosetu.org'):
+        super().__init__(parser)
+        # base_url can point at a stand-in server (see bench/scrape_bench.py).
+        self.base_url = base_url.rstrip('/')
+        # Any scheme, including the scheme-relative links in search results.
+        self.url_pattern = re.compile(r'(?<![\w.-])' + re.escape(urlsplit(self.base_url).netloc) + r'/novel/(\d+)/')
+
+    def get_novel_url(self, nid):
+        return f"{self.base_url}/novel/{nid}/"
+
+    def get_chapter_url(self, novel_url, index):
+        return f'{novel_url}{index+1}.html'
+
+    def get_cookies(self, nid, wasuu=None):
+        return {'ETURAN': f'{nid}_{wasuu}', 'over18': 'off'} if wasuu else {'over18': 'off'}
+
+    def get_toc(self, fetch, novel_url, nid, cached, get_stored):
+        response = fetch(novel_url, headers=get_validator_headers(cached))
+        if response.status_code == 304 and cached:
+            return None
+        title, updated_at = self.parser.parse_toc(response.text)
+        return Toc(
+            title, [(self.get_chapter_url(novel_url, i), None) for i in range(len(updated_at))], updated_at,
+            response.headers.get('ETag'), response.headers.get('Last-Modified')
+        )
+
+    def parse_chapter(self, page, group=None):
+        chapter_title_html, paragraphs = self.parser.parse_chapter(page)
+        return get_title_lines(chapter_title_html), paragraphs
+
+
+class NarouSite(Site):
+    name = 'ncode_syosetu_com'
+    url_pattern = re.compile(r'https://ncode.syosetu.com/([a-z0-9]+)/')
+    nid_pattern = re.compile(r'n[0-9a-z]+')
+    honbun_pattern = re.compile(r'<div class="js-novel-text p-novel__text">(.*?)</div>', re.S)
+    title_pattern = re.compile(r'<h1 class="p-novel__title[^"]*">(.*?)</h1>', re.S)
+    referers = [
+        "https://www.google.com/search?q=%E5%B0%8F%E8%AA%AC%E5%AE%B6%E3%81%AB%E3%81%AA%E3%82%8D%E3%81%86&ie=utf-8&oe=utf-8",
+        "https://www.google.com/search?q=%E5%B0%8F%E8%AA%AC%E3%82%92%E8%AA%AD%E3%82%82%E3%81%86&ie=utf-8&oe=utf-8",
+        "https://syosetu.com/user/top/",
+        "https://syosetu.com/favnovelmain/list/?nowcategory=2&order=newlist",
+        "https://yomou.syosetu.com/search.php",
+        "https://yomou.syosetu.com/rank/top/"
+    ]
+
+    def __init__(self, parser, api_url='https://api.syosetu.com/novelapi/api/', workers=2):
+        super().__init__(parser)
+        self.api_url = api_url
+        self.workers = workers
+
+    def get_novel_url(self, nid):
+        return f"https://ncode.syosetu.com/{nid}/"
+
+    def get_chapter_url(self, novel_url, index):
+        return f'{novel_url}{index+1}/'
+
+    def get_cookies(self, nid, wasuu=None):
+        return {'over18': 'yes'}
+
+    def get_meta(self, fetch, nid):
+        # One API call gives the title, episode count, type and last update.
+        response = fetch(f"{self.api_url}?{urlencode({'out': 'json', 'of': 't-ga-nt-nu', 'ncode': nid})}", headers={"Accept": "application/json"})
+        results = json.loads(response.text)
+        if len(results) < 2:
+            raise ValueError(f"{nid} was not found")
+        return results[1]
+
+    def get_toc(self, fetch, novel_url, nid, cached, get_stored):
+        meta = self.get_meta(fetch, nid)
+        title, modified = meta['title'], meta['novelupdated_at']
+        if meta['noveltype'] == 2:
+            # Short stories have no TOC; the novel page holds the whole text.
+            return Toc(title, [(novel_url, None)], [modified[:16]], None, modified)
+
+        # The TOC is paginated (100 episodes a page), so it is only walked when
+        # the API reports a change or some chapter has left the store.
+        previous_updated_at = cached['updated_at'] if cached else []
+        if cached and cached['last_modified'] == modified and len(previous_updated_at) == meta['general_all_no']:
+            stored = get_stored()
+            if all(stored.get(i + 1) == chapter_updated_at for i, chapter_updated_at in enumerate(previous_updated_at)):
+                return None
+
+        def get_page(page):
+            return self.parser.parse_narou_toc(fetch(f'{novel_url}?p={page}' if page > 1 else novel_url).text)
+
+        _, chapters, last_page = get_page(1)
+        if last_page > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for _, page_chapters, _ in executor.map(get_page, range(2, last_page + 1)):
+                    chapters += page_chapters
+        return Toc(
+            title, [(f'{novel_url}{wasuu}/', group) for wasuu, group, _ in chapters],
+            [chapter_updated_at for _, _, chapter_updated_at in chapters], None, modified
+        )
+
+    def parse_chapter(self, page, group=None):
+        subtitle_html, paragraphs = self.parser.parse_narou_chapter(page)
+        return ([group] if group else []) + get_title_lines(subtitle_html), paragraphs
+
+
+class SiteRegistry:
+    def __init__(self, sites):
+        self.sites = {site.name: site for site in sites}
+
+    def __iter__(self):
+        return iter(self.sites.values())
+
+    def get(self, name):
+        return self.sites[name]
+
+    def match(self, url):
+        for site in self:
+            nid = site.match(url)
+            if nid:
+                return site, nid
+        return None, None
+
+    def find(self, nid):
+        return next((site for site in self if site.owns(nid)), None)
@@ -0,0 +1,64 @@
+import os
+
+
+class NovelSpool:
+    # Writes chapters to disk in order as they arrive, holding only the
+    # out-of-order ones in memory. Every run of chapters that becomes
+    # contiguous is passed through transform and written in one call. The
+    # untransformed chapters are also stored in archive, if one is given.
+    def __init__(self, path, chapter_count, cached, load_chapter, transform=None, archive=None):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.tmp_path = f'{path}.{os.getpid()}.tmp'
+        self.chapter_count = chapter_count
+        self.cached = set(cached)
+        self.load_chapter = load_chapter
+        self.transform = transform
+        self.archive = archive
+        self.pending = {}
+        self.next_index = 0
+        self.written = False
+        self.file = open(self.tmp_path, 'w', encoding='utf-8', newline='')
+
+    def add(self, index, text):
+        self.pending[index] = text
+        self._flush()
+
+    def _flush(self, final=False):
+        batch = []
+        while self.next_index < self.chapter_count:
+            if self.next_index in self.pending:
+                text = self.pending.pop(self.next_index)
+            elif self.next_index in self.cached:
+                text = self.load_chapter(self.next_index)
+            elif final:
+                # Missing from this run; keep whatever the archive already has.
+                self.next_index += 1
+                continue
+            else:
+                break
+            if self.archive is not None:
+                self.archive.put_chapter(self.next_index, text)
+            if text:
+                batch.append(self.transform(text) if self.transform else text)
+            self.next_index += 1
+        if batch:
+            if self.written:
+                self.file.write('\n\n')
+            self.file.write('\n\n'.join(batch))
+            self.written = True
+
+    def close(self):
+        self._flush(final=True)
+        self.file.close()
+        if self.archive is not None:
+            self.archive.close()
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        self.file.close()
+        if self.archive is not None:
+            self.archive.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)